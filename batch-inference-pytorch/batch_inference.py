@@ -13,20 +13,29 @@
 # limitations under the License.
 
 import os
+import collections
 import csv
+import hashlib
 import io
+import json
+import queue
+import tempfile
+import threading
 import time
 from pathlib import Path
 
 import torch
 import torch.distributed as dist
-from torch.utils.data.distributed import DistributedSampler
-from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 from torchvision import transforms
+from torchvision.transforms.v2 import functional as TF
 from transformers import ViTImageProcessor, ViTForImageClassification
 from PIL import Image
 from tqdm import tqdm
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as pads
+import pyarrow.parquet as pq
 import sys
 
 from dataflux_pytorch import dataflux_mapstyle_dataset
@@ -38,7 +47,50 @@ OUTPUT_PATH = os.getenv('OUTPUT_PATH')
 IMAGE_PREFIX = "path/"
 MODEL_ID = "google/vit-base-patch16-224"
 BATCH_SIZE = 64
-NUM_WORKERS = 12
+# Processes DataFlux uses to list the bucket prefix.
+LISTING_PROCESSES = int(os.getenv("LISTING_PROCESSES", "12"))
+# DataLoader worker processes per rank that fetch, decode and transform
+# images, and how many batches each keeps ready ahead of the GPU.
+DECODE_WORKERS = int(os.getenv("DECODE_WORKERS", "8"))
+PREFETCH_FACTOR = int(os.getenv("PREFETCH_FACTOR", "4"))
+PERSISTENT_WORKERS = os.getenv("PERSISTENT_WORKERS", "true").lower() == "true"
+# "per_image" runs the torchvision PIL pipeline on every image in the
+# workers. "batched" only decodes to uint8 there; resizing, scaling and
+# normalization run per batch on the GPU.
+PREPROCESS_MODE = os.getenv("PREPROCESS_MODE", "per_image")
+# Let libjpeg decode at a reduced scale no smaller than the model input.
+DRAFT_DECODE = os.getenv("DRAFT_DECODE", "false").lower() == "true"
+# "csv" writes image_id,classification rows. "parquet" writes row groups of
+# PARQUET_ROW_GROUP_ROWS from a background thread, keeping the TOP_K class
+# ids and probabilities per image, and rank 0 merges the shards into a
+# dataset partitioned by run when MERGE_RESULTS is set.
+RESULT_FORMAT = os.getenv("RESULT_FORMAT", "csv")
+TOP_K = int(os.getenv("TOP_K", "5"))
+PARQUET_ROW_GROUP_ROWS = int(os.getenv("PARQUET_ROW_GROUP_ROWS", "262144"))
+MERGE_RESULTS = os.getenv("MERGE_RESULTS", "true").lower() == "true"
+# Results and progress manifests are named after RUN_ID, so a restarted job
+# skips the images it already finished. It defaults to a hash of the inputs,
+# the model and the object listing, so a changed listing starts a new run;
+# set a new RUN_ID to start over.
+RUN_ID = os.getenv("RUN_ID", "")
+# Rank 0 lists IMAGE_PREFIX once and saves the sorted listing next to the
+# results for the other ranks. With LISTING_CACHE_TTL_S > 0, later runs reuse
+# a listing younger than that and don't see objects added since.
+LISTING_CACHE_TTL_S = float(os.getenv("LISTING_CACHE_TTL_S", "0"))
+# How each rank runs the model: "eager", "compiled" (torch.compile),
+# "torchscript" (traced and frozen) or "onnx" (exported to ONNX Runtime).
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "eager")
+# "bf16" and "fp16" autocast the eager and compiled backends and cast the
+# weights of the exported ones; "fp32" runs at full precision.
+PRECISION = os.getenv("PRECISION", "bf16")
+# torch.inference_mode() instead of torch.no_grad().
+INFERENCE_MODE = os.getenv("INFERENCE_MODE", "true").lower() == "true"
+# "dynamic" lets ranks claim SHARD_CHUNK_SIZE images at a time from a shared
+# counter as they go; "static" gives each rank a fixed stride up front.
+SHARDING = os.getenv("SHARDING", "dynamic")
+SHARD_CHUNK_SIZE = int(os.getenv("SHARD_CHUNK_SIZE", "2048"))
+# Seconds between progress checkpoints.
+CHECKPOINT_INTERVAL_S = float(os.getenv("CHECKPOINT_INTERVAL_S", "300"))
 OUTPUT_DIR = Path(f"{OUTPUT_PATH}/inference_results")
 
 # --- HELPER FUNCTIONS  ---
@@ -49,26 +101,632 @@ def setup_distributed():
 def cleanup_distributed():
     dist.destroy_process_group()
 
+def create_shard_store(host, global_rank, prefix):
+    """Returns a store shared by all ranks for claiming shard chunks.
+
+    Rank 0 hosts a TCPStore on a free port, which it broadcasts over the
+    process group, and the other ranks connect to it at `host`; keys are
+    kept under `prefix`. The store lives in rank 0's process, so callers
+    must keep rank 0 running until every rank is done with it.
+    """
+    if global_rank == 0:
+        store = dist.TCPStore(host, 0, is_master=True, wait_for_workers=False)
+        port = [store.port]
+    else:
+        port = [None]
+    dist.broadcast_object_list(port, src=0)
+    if global_rank != 0:
+        store = dist.TCPStore(host, port[0], is_master=False)
+    return dist.PrefixStore(prefix, store)
+
 def get_image_id_from_path(gcs_path: str) -> str:
     return Path(gcs_path).stem
 
-def create_collate_fn():
+def decode_image(img_in_bytes, draft_size=None):
+    """Decodes to RGB; `draft_size` is the smallest (width, height) needed."""
+    image = Image.open(io.BytesIO(img_in_bytes))
+    if draft_size:
+        # Only JPEG supports draft mode; other formats ignore it.
+        image.draft("RGB", draft_size)
+    return image.convert("RGB")
+
+def create_collate_fn(group_by_shape=False):
+    """Stacks a batch of (image_id, tensor) items.
+
+    With `group_by_shape`, uint8 CHW images of different sizes are stacked
+    per shape instead, returning (indices, images) groups that the function
+    from create_preprocess_fn resizes and normalizes on the device.
+    """
     def collate_fn(batch):
         image_ids = [item[0] for item in batch]
-        image_tensors = torch.stack([item[1] for item in batch], dim=0)
-        return image_ids, image_tensors
+        if not group_by_shape:
+            image_tensors = torch.stack([item[1] for item in batch], dim=0)
+            return image_ids, image_tensors
+        by_shape = {}
+        for i, item in enumerate(batch):
+            by_shape.setdefault(tuple(item[1].shape), []).append(i)
+        groups = [
+            (torch.tensor(indices), torch.stack([batch[i][1] for i in indices], dim=0))
+            for indices in by_shape.values()
+        ]
+        return image_ids, groups
     return collate_fn
 
-# This simple dataset works directly with the global indices provided by the DistributedSampler.
+def create_preprocess_fn(mean, std, size, device):
+    """Returns a function turning collated uint8 groups into a model batch.
+
+    Each group is copied to `device`, resized to `size` with one antialiased
+    bilinear call, then the whole batch is scaled, normalized and made
+    channels-last, so workers only decode.
+    """
+    # (x / 255 - mean) / std folded into a single multiply-add.
+    scale = torch.tensor([1 / (255 * s) for s in std], device=device).view(1, 3, 1, 1)
+    shift = torch.tensor([-m / s for m, s in zip(mean, std)], device=device).view(1, 3, 1, 1)
+    def preprocess_fn(groups):
+        count = sum(len(indices) for indices, _ in groups)
+        batch = torch.empty((count, 3, *size), dtype=torch.float32, device=device)
+        for indices, images in groups:
+            images = images.to(device, non_blocking=True).float()
+            if tuple(images.shape[-2:]) != tuple(size):
+                images = torch.nn.functional.interpolate(
+                    images, size=tuple(size), mode="bilinear", antialias=True, align_corners=False
+                )
+            batch[indices.to(device, non_blocking=True)] = images
+        batch = torch.addcmul(shift, batch, scale)
+        return batch.contiguous(memory_format=torch.channels_last)
+    return preprocess_fn
+
+# --- INFERENCE BACKENDS ---
+DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+class LogitsOnly(torch.nn.Module):
+    """Exposes a Hugging Face classifier as a plain tensor -> logits module."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model(pixel_values=pixel_values).logits
+
+
+class EagerBackend:
+    """Runs the model as is, autocast to `precision` unless it is fp32."""
+
+    def __init__(self, model, device, precision, example_input, inference_context=torch.no_grad):
+        self.device = device
+        self.dtype = DTYPES[precision]
+        self.module = LogitsOnly(model).eval().to(device)
+
+    def __call__(self, pixel_values):
+        with torch.autocast(device_type=self.device.type, dtype=self.dtype,
+                            enabled=self.dtype != torch.float32):
+            return self.module(pixel_values)
+
+
+class CompiledBackend(EagerBackend):
+    """Compiles the model on construction with a dynamic batch dimension.
+
+    The warmup runs under the same `inference_context` as the inference
+    loop, since guards on grad mode would otherwise recompile on the first
+    batch, and a smaller final batch reuses the same graph.
+    """
+
+    def __init__(self, model, device, precision, example_input, inference_context=torch.no_grad):
+        super().__init__(model, device, precision, example_input)
+        self.module = torch.compile(self.module)
+        example_input = example_input.to(device)
+        # Dynamo always specializes size 1, so it can't be marked dynamic.
+        if example_input.shape[0] > 1:
+            torch._dynamo.mark_dynamic(example_input, 0)
+        with inference_context():
+            self(example_input)
+
+
+class TorchScriptBackend(EagerBackend):
+    """Traces and freezes the model with its weights cast to `precision`."""
+
+    def __init__(self, model, device, precision, example_input, inference_context=torch.no_grad):
+        super().__init__(model, device, precision, example_input)
+        self.module = self.module.to(self.dtype)
+        with torch.no_grad():
+            traced = torch.jit.trace(self.module, example_input.to(device, self.dtype))
+        self.module = torch.jit.freeze(traced)
+
+    def __call__(self, pixel_values):
+        return self.module(pixel_values.to(self.dtype))
+
+
+class OnnxRuntimeBackend(EagerBackend):
+    """Exports the model to ONNX and runs it with ONNX Runtime.
+
+    On GPU, inputs and outputs are bound to CUDA memory so batches never
+    leave the device.
+    """
+
+    def __init__(self, model, device, precision, example_input, inference_context=torch.no_grad):
+        import onnxruntime as ort
+
+        if precision == "bf16":
+            raise ValueError("The onnx backend supports fp32 and fp16 precision")
+        super().__init__(model, device, precision, example_input)
+        module = self.module.to(self.dtype)
+        self.num_labels = model.config.num_labels
+        path = os.path.join(tempfile.mkdtemp(), "model.onnx")
+        with torch.no_grad():
+            torch.onnx.export(
+                module, (example_input.to(device, self.dtype),), path,
+                input_names=["pixel_values"], output_names=["logits"],
+                dynamic_axes={"pixel_values": {0: "batch"}, "logits": {0: "batch"}},
+            )
+        providers = ["CPUExecutionProvider"]
+        if device.type == "cuda":
+            providers.insert(0, ("CUDAExecutionProvider", {"device_id": device.index or 0}))
+        self.session = ort.InferenceSession(path, providers=providers)
+        self.element_type = {torch.float32: np.float32, torch.float16: np.float16}[self.dtype]
+
+    def __call__(self, pixel_values):
+        pixel_values = pixel_values.to(self.dtype).contiguous()
+        if self.device.type != "cuda":
+            logits, = self.session.run(["logits"], {"pixel_values": pixel_values.numpy()})
+            return torch.from_numpy(logits)
+        logits = torch.empty((pixel_values.shape[0], self.num_labels), dtype=self.dtype, device=self.device)
+        binding = self.session.io_binding()
+        for name, tensor in (("pixel_values", pixel_values), ("logits", logits)):
+            bind = binding.bind_input if name == "pixel_values" else binding.bind_output
+            bind(name, "cuda", self.device.index or 0, self.element_type,
+                 tuple(tensor.shape), tensor.data_ptr())
+        # ONNX Runtime uses its own stream; the input must be ready first.
+        torch.cuda.synchronize(self.device)
+        self.session.run_with_iobinding(binding)
+        return logits
+
+
+BACKENDS = {
+    "eager": EagerBackend,
+    "compiled": CompiledBackend,
+    "torchscript": TorchScriptBackend,
+    "onnx": OnnxRuntimeBackend,
+}
+
+
+def create_backend(name, model, device, precision, example_input, inference_context=torch.no_grad):
+    """Returns a callable mapping a pixel batch on `device` to logits.
+
+    `inference_context` is the grad mode the backend will be called under.
+    """
+    return BACKENDS[name](model, device, precision, example_input, inference_context)
+
+# --- RESULT SINKS ---
+class ResultSink:
+    """Receives (image_ids, top_ids, top_probs) batches for one rank's shard.
+
+    checkpoint() makes everything written so far durable and returns the
+    state a restarted rank passes back in as `resume_state` to continue the
+    shard without duplicating or losing rows.
+
+    Sinks write each checkpoint interval to a new `<stem>_part_<n>` file
+    rather than appending to one, since gcsfuse uploads a whole object
+    again whenever it is synced.
+    """
+
+    format = None
+    suffix = None
+
+    @classmethod
+    def part_path(cls, path_stem, part):
+        return path_stem.with_name(f"{path_stem.name}_part_{part:05d}{cls.suffix}")
+
+    @classmethod
+    def remove_uncommitted_parts(cls, path_stem, parts):
+        # Parts from after the last checkpoint may be incomplete.
+        for path in path_stem.parent.glob(f"{path_stem.name}_part_*{cls.suffix}"):
+            if int(path.stem.rsplit("_", 1)[1]) >= parts:
+                path.unlink()
+
+    def write(self, image_ids, top_ids, top_probs):
+        raise NotImplementedError
+
+    def checkpoint(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CsvResultSink(ResultSink):
+    """Writes the top-1 label of each image as image_id,classification rows.
+
+    Every `<stem>_part_<n>.csv` file starts with its own header row.
+    """
+
+    format = "csv"
+    suffix = ".csv"
+
+    def __init__(self, path_stem, labels, resume_state=None):
+        self.path_stem = path_stem
+        self.labels = labels
+        # Rows past the last checkpoint are written again on resume.
+        self.part = resume_state["parts"] if resume_state else 0
+        self.remove_uncommitted_parts(path_stem, self.part)
+        self.path = self.part_path(path_stem, self.part)
+        self._file = None
+        self._writer = None
+
+    def write(self, image_ids, top_ids, top_probs):
+        if self._file is None:
+            self.path = self.part_path(self.path_stem, self.part)
+            self._file = open(self.path, 'w', newline='')
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(['image_id', 'classification'])
+        self._writer.writerows(
+            [image_id, self.labels[ids[0]]] for image_id, ids in zip(image_ids, top_ids)
+        )
+
+    def checkpoint(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+            self.part += 1
+        return {"format": self.format, "parts": self.part}
+
+    def close(self):
+        self.checkpoint()
+
+
+class ParquetResultSink(ResultSink):
+    """Buffers results into large Parquet row groups written off the main loop.
+
+    Each row holds the image id, top-1 class id and label, and the top-k
+    class ids and probabilities as fixed-width lists. A Parquet file is only
+    readable once closed, so every checkpoint closes the current
+    `<stem>_part_<n>.parquet` file and the next write starts a new one.
+    """
+
+    format = "parquet"
+    suffix = ".parquet"
+
+    def __init__(self, path_stem, labels, top_k, row_group_rows, resume_state=None):
+        self.path_stem = path_stem
+        self.labels = labels
+        self.row_group_rows = row_group_rows
+        self.schema = pa.schema([
+            ("image_id", pa.string()),
+            ("class_id", pa.int32()),
+            ("classification", pa.string()),
+            ("top_k_ids", pa.list_(pa.int32(), top_k)),
+            ("top_k_probs", pa.list_(pa.float32(), top_k)),
+        ])
+        self.part = resume_state["parts"] if resume_state else 0
+        self.remove_uncommitted_parts(path_stem, self.part)
+        self.path = self.part_path(path_stem, self.part)
+        self._buffer = []
+        self._buffered_rows = 0
+        self._queue = None
+        self._thread = None
+        self._error = None
+
+    def _open_part(self):
+        self.path = self.part_path(self.path_stem, self.part)
+        # Two pending row groups at most, so a slow filesystem applies
+        # backpressure instead of growing memory.
+        self._queue = queue.Queue(maxsize=2)
+        self._thread = threading.Thread(
+            target=self._write_row_groups, args=(self.path, self._queue), daemon=True
+        )
+        self._thread.start()
+
+    def _write_row_groups(self, path, tables):
+        try:
+            with pq.ParquetWriter(path, self.schema, compression="zstd") as writer:
+                while (table := tables.get()) is not None:
+                    writer.write_table(table, row_group_size=len(table))
+        except Exception as e:
+            self._error = e
+            # Keep draining so the main loop never blocks on a full queue.
+            while tables.get() is not None:
+                pass
+
+    def write(self, image_ids, top_ids, top_probs):
+        if self._error:
+            raise self._error
+        self._buffer.append((list(image_ids), top_ids, top_probs))
+        self._buffered_rows += len(image_ids)
+        if self._buffered_rows >= self.row_group_rows:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        if self._thread is None:
+            self._open_part()
+        image_ids = [i for ids, _, _ in self._buffer for i in ids]
+        top_ids = np.concatenate([ids for _, ids, _ in self._buffer]).astype(np.int32)
+        top_probs = np.concatenate([probs for _, _, probs in self._buffer]).astype(np.float32)
+        k = top_ids.shape[1]
+        class_ids = pa.array(np.ascontiguousarray(top_ids[:, 0]))
+        self._queue.put(pa.table([
+            pa.array(image_ids, pa.string()),
+            class_ids,
+            pa.array(self.labels, pa.string()).take(class_ids),
+            pa.FixedSizeListArray.from_arrays(pa.array(top_ids.reshape(-1)), k),
+            pa.FixedSizeListArray.from_arrays(pa.array(top_probs.reshape(-1)), k),
+        ], schema=self.schema))
+        self._buffer = []
+        self._buffered_rows = 0
+
+    def checkpoint(self):
+        self._flush()
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            if self._error:
+                raise self._error
+            self.part += 1
+        return {"format": self.format, "parts": self.part}
+
+    def close(self):
+        self.checkpoint()
+
+
+def create_result_sink(path_stem, labels, resume_state=None):
+    if RESULT_FORMAT == "parquet":
+        return ParquetResultSink(
+            path_stem, labels, max(TOP_K, 1), PARQUET_ROW_GROUP_ROWS, resume_state
+        )
+    return CsvResultSink(path_stem, labels, resume_state)
+
+
+class ProgressManifest:
+    """Per-rank record of the dataset indices whose results are durable.
+
+    Indices are appended as int64 to `progress_<run>_shard_<rank>.bin`; the
+    JSON file next to it holds how many of them are committed plus the result
+    sink's checkpoint state, and is replaced atomically after the indices are
+    synced, so a crash at any point leaves a consistent manifest. It also
+    records the digest of the object listing the indices point into.
+    """
+
+    def __init__(self, output_dir, run_id, rank, listing):
+        self.bin_path = output_dir / f"progress_{run_id}_shard_{rank}.bin"
+        self.state_path = output_dir / f"progress_{run_id}_shard_{rank}.json"
+        self.listing = listing
+        self.state = self.read_state(self.state_path) or {"indices": 0, "sink": None}
+
+    @staticmethod
+    def read_state(state_path):
+        try:
+            return json.loads(state_path.read_text())
+        except FileNotFoundError:
+            return None
+
+    @classmethod
+    def completed_indices(cls, output_dir, run_id, listing):
+        """Committed indices of every rank, so a resized job resumes too."""
+        completed = []
+        for state_path in output_dir.glob(f"progress_{run_id}_shard_*.json"):
+            state = cls.read_state(state_path)
+            if state.get("listing") != listing:
+                raise ValueError(
+                    f"Run {run_id} was started on a different object listing than "
+                    f"the current one; set a new RUN_ID to start over"
+                )
+            completed.append(np.fromfile(
+                state_path.with_suffix(".bin"), dtype=np.int64, count=state["indices"]
+            ))
+        return np.unique(np.concatenate(completed)) if completed else np.empty(0, np.int64)
+
+    @classmethod
+    def result_formats(cls, output_dir, run_id):
+        """Formats of the result shards any rank has already committed."""
+        formats = set()
+        for state_path in output_dir.glob(f"progress_{run_id}_shard_*.json"):
+            sink_state = cls.read_state(state_path)["sink"]
+            if sink_state:
+                formats.add(sink_state["format"])
+        return formats
+
+    @classmethod
+    def committed_parquet_parts(cls, output_dir, run_id):
+        paths = []
+        for state_path in sorted(output_dir.glob(f"progress_{run_id}_shard_*.json")):
+            state = cls.read_state(state_path)
+            rank = state_path.stem.rsplit("_", 1)[1]
+            path_stem = output_dir / f"results_{run_id}_shard_{rank}"
+            paths += [
+                ParquetResultSink.part_path(path_stem, part)
+                for part in range((state["sink"] or {}).get("parts", 0))
+            ]
+        return paths
+
+    def commit(self, indices, sink_state):
+        with open(self.bin_path, "ab") as f:
+            # Drop indices appended after the last committed state.
+            f.truncate(self.state["indices"] * 8)
+            np.asarray(indices, dtype=np.int64).tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        self.state = {
+            "listing": self.listing,
+            "indices": self.state["indices"] + len(indices),
+            "sink": sink_state,
+        }
+        tmp_path = self.state_path.with_suffix(".json.tmp")
+        tmp_path.write_text(json.dumps(self.state))
+        os.replace(tmp_path, self.state_path)
+
+
+def merge_result_shards(output_dir, run_id):
+    """Combines one run's committed Parquet parts into output_dir/dataset/run=<run_id>."""
+    parts = ProgressManifest.committed_parquet_parts(output_dir, run_id)
+    dataset_dir = output_dir / "dataset" / f"run={run_id}"
+    pads.write_dataset(
+        pads.dataset([str(part) for part in parts], format="parquet"),
+        dataset_dir,
+        format="parquet",
+        basename_template="part-{i}.parquet",
+        max_rows_per_group=PARQUET_ROW_GROUP_ROWS,
+        min_rows_per_group=PARQUET_ROW_GROUP_ROWS,
+        existing_data_behavior="delete_matching",
+    )
+    return dataset_dir
+
+
+class IndexSampler(Sampler):
+    """Yields a fixed share of the dataset indices in order.
+
+    Indices are also queued on `issued` as they are handed to the DataLoader,
+    which keeps batches in sampler order, so the main loop can take() the
+    indices of each batch it receives.
+    """
+
+    def __init__(self, indices):
+        self.indices = indices
+        self.issued = collections.deque()
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        for idx in self.indices:
+            self.issued.append(int(idx))
+            yield int(idx)
+
+    def take(self, count):
+        return [self.issued.popleft() for _ in range(count)]
+
+
+class WorkQueueSampler(IndexSampler):
+    """Hands out chunks of `indices` to whichever rank asks first.
+
+    Every rank passes the same indices. Chunks are claimed through an atomic
+    counter in a torch.distributed Store (see create_shard_store), so a slow rank simply claims fewer chunks instead of holding
+    up the job. Finished chunks are counted under the same `key_prefix`.
+    """
+
+    def __init__(self, indices, store, key_prefix, chunk_size, world_size):
+        super().__init__(indices)
+        self.store = store
+        self.chunk_size = chunk_size
+        self.num_chunks = -(-len(indices) // chunk_size)
+        self.world_size = world_size
+        self._next_key = f"{key_prefix}/next_chunk"
+        self._done_key = f"{key_prefix}/done_chunks"
+        self.chunks_claimed = 0
+        self.chunks_done = 0
+
+    def __len__(self):
+        # Only an estimate; the real share depends on the other ranks.
+        return -(-len(self.indices) // self.world_size)
+
+    def __iter__(self):
+        while (chunk := self.store.add(self._next_key, 1) - 1) < self.num_chunks:
+            self.chunks_claimed += 1
+            start = chunk * self.chunk_size
+            indices = self.indices[start:start + self.chunk_size]
+            for i, idx in enumerate(indices):
+                self.issued.append((int(idx), i == len(indices) - 1))
+                yield int(idx)
+
+    def take(self, count):
+        taken = []
+        for _ in range(count):
+            idx, last_in_chunk = self.issued.popleft()
+            if last_in_chunk:
+                self.chunks_done = self.store.add(self._done_key, 1)
+            taken.append(idx)
+        return taken
+
+# --- OBJECT LISTING ---
+class ListedDataFluxDataset(dataflux_mapstyle_dataset.DataFluxMapStyleDataset):
+    """DataFlux dataset over a known (name, size) object list, without listing."""
+
+    def __init__(self, objects, **kwargs):
+        self._listed_objects = objects
+        super().__init__(**kwargs)
+
+    def _list_GCS_blobs_with_retry(self):
+        return self._listed_objects
+
+
+def list_objects():
+    listing = dataflux_mapstyle_dataset.DataFluxMapStyleDataset(
+        project_name=PROJECT_NAME,
+        bucket_name=BUCKET_NAME,
+        config=dataflux_mapstyle_dataset.Config(
+            prefix=IMAGE_PREFIX,
+            sort_listing_results=True,
+            num_processes=LISTING_PROCESSES
+        ),
+    )
+    return sorted(listing.objects)
+
+
+def save_listing(path, objects):
+    table = pa.table({
+        "name": pa.array([name for name, _ in objects], pa.string()),
+        "size": pa.array([size for _, size in objects], pa.int64()),
+    })
+    tmp_path = path.with_suffix(".parquet.tmp")
+    pq.write_table(table, tmp_path, compression="zstd")
+    os.replace(tmp_path, path)
+
+
+def load_listing(path):
+    table = pq.read_table(path)
+    return list(zip(table["name"].to_pylist(), table["size"].to_pylist()))
+
+
+def listing_digest(objects):
+    """Content hash of a listing; progress indices are only valid against it."""
+    digest = hashlib.sha1()
+    for name, size in objects:
+        digest.update(f"{name}\t{size}\n".encode())
+    return digest.hexdigest()
+
+
+def shared_listing(global_rank, local_rank):
+    """Returns the sorted (name, size) objects under IMAGE_PREFIX on every rank.
+
+    Only rank 0 lists the bucket, when no usable cached listing exists; the
+    other ranks wait at a barrier and then read the listing file from the
+    shared output directory.
+    """
+    prefix_hash = hashlib.sha1(f"{BUCKET_NAME}/{IMAGE_PREFIX}".encode()).hexdigest()[:12]
+    path = OUTPUT_DIR / f"listing_{prefix_hash}.parquet"
+    if global_rank == 0:
+        if path.exists() and time.time() - path.stat().st_mtime < LISTING_CACHE_TTL_S:
+            print(f"--- 🚀 Reusing object listing {path}; objects added since it was "
+                  f"saved are skipped (LISTING_CACHE_TTL_S={LISTING_CACHE_TTL_S:g}) ---")
+        else:
+            print(f"--- 🚀 Listing gs://{BUCKET_NAME}/{IMAGE_PREFIX} with num_processes: {LISTING_PROCESSES} ---")
+            start = time.perf_counter()
+            save_listing(path, list_objects())
+            print(f"--- 🚀 Listed bucket in {time.perf_counter() - start:.1f}s ---")
+    dist.barrier(device_ids=[local_rank])
+    return load_listing(path)
+
+# This simple dataset works directly with the global indices provided by the sampler.
 class DataFluxWrapperDataset(Dataset):
     """
     A lightweight wrapper for a DataFlux dataset. It is designed to
-    work with PyTorch's DistributedSampler by using global indices to
+    work with a distributed sampler by using global indices to
     fetch data and metadata.
     """
-    def __init__(self, dataflux_dataset, transform_fn=None):
+    def __init__(self, dataflux_dataset, transform_fn=None, draft_size=None):
         self.dataflux_dataset = dataflux_dataset
         self.transform_fn = transform_fn
+        self.draft_size = draft_size
 
     def __len__(self):
         # The length is the total number of objects in the dataset.
@@ -83,7 +741,7 @@ class DataFluxWrapperDataset(Dataset):
         img_in_bytes = self.dataflux_dataset[idx]
 
         # 3. Apply transformations.
-        image = Image.open(io.BytesIO(img_in_bytes)).convert("RGB")
+        image = decode_image(img_in_bytes, self.draft_size)
         if self.transform_fn:
             tensor = self.transform_fn(image)
         else:
@@ -104,79 +762,154 @@ def run_batch_inference():
     # --- 2. Setup Model  ---
     if global_rank == 0: print("--- 🚀 Preparing model ---")
     processor = ViTImageProcessor.from_pretrained(MODEL_ID)
-    model = ViTForImageClassification.from_pretrained(MODEL_ID).to(local_rank)
-    model = DDP(model, device_ids=[local_rank], find_unused_parameters=True)
-    model.eval()
+    image_size = (processor.size['height'], processor.size['width'])
+    # Inference never syncs gradients, so each rank runs its own copy of the
+    # model without a DistributedDataParallel wrapper.
+    model = ViTForImageClassification.from_pretrained(MODEL_ID)
+    inference_context = torch.inference_mode if INFERENCE_MODE else torch.no_grad
+    backend = create_backend(
+        INFERENCE_BACKEND, model, torch.device("cuda", local_rank), PRECISION,
+        torch.zeros((BATCH_SIZE, 3, *image_size)), inference_context,
+    )
+    if global_rank == 0: print(f"--- 🚀 Running {INFERENCE_BACKEND} backend at {PRECISION} ---")
 
     # --- 3. Setup Dataset and DataLoader ---
-    if global_rank == 0: print("--- 🚀 Preparing image transform pipeline ---")
-    image_transform_pipeline = transforms.Compose([
-        transforms.Resize((processor.size['height'], processor.size['width'])),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=processor.image_mean, std=processor.image_std)
-    ])
-
-    if global_rank == 0: print(f"--- 🚀 Preparing dataflux map style dataset with num_processes: {NUM_WORKERS} ---")
-    base_dataflux_dataset = dataflux_mapstyle_dataset.DataFluxMapStyleDataset(
+    if global_rank == 0: print(f"--- 🚀 Preparing {PREPROCESS_MODE} image transform pipeline ---")
+    if PREPROCESS_MODE == "batched":
+        image_transform_pipeline = TF.pil_to_tensor
+        collate_fn = create_collate_fn(group_by_shape=True)
+        preprocess_fn = create_preprocess_fn(
+            processor.image_mean, processor.image_std, image_size, torch.device("cuda", local_rank)
+        )
+    else:
+        image_transform_pipeline = transforms.Compose([
+            transforms.Resize(image_size),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=processor.image_mean, std=processor.image_std)
+        ])
+        collate_fn = create_collate_fn()
+        preprocess_fn = None
+
+    if global_rank == 0: print("--- 🚀 Preparing dataflux map style dataset ---")
+    # Progress manifests refer to positions in this sorted listing, so the
+    # run is tied to its content.
+    objects = shared_listing(global_rank, local_rank)
+    listing = listing_digest(objects)
+    run_id = RUN_ID or hashlib.sha1(
+        f"{BUCKET_NAME}/{IMAGE_PREFIX}:{MODEL_ID}:{listing}".encode()).hexdigest()[:12]
+    base_dataflux_dataset = ListedDataFluxDataset(
+        objects,
         project_name=PROJECT_NAME,
         bucket_name=BUCKET_NAME,
-        config=dataflux_mapstyle_dataset.Config(
-            prefix=IMAGE_PREFIX,
-            sort_listing_results=False,
-            num_processes=NUM_WORKERS
-        ),
+        config=dataflux_mapstyle_dataset.Config(prefix=IMAGE_PREFIX),
     )
 
     dataset = DataFluxWrapperDataset(
         dataflux_dataset=base_dataflux_dataset,
-        transform_fn=image_transform_pipeline
+        transform_fn=image_transform_pipeline,
+        draft_size=image_size[::-1] if DRAFT_DECODE else None,
     )
     
     if global_rank == 0: print(f"Found {len(dataset)} total images.")
 
-    sampler = DistributedSampler(
-        dataset,
-        num_replicas=world_size,
-        rank=global_rank,
-        shuffle=False 
-    )
-
-    print(f"Rank {global_rank}: Sampler will give {len(sampler)} images to this process.")
-
+    # Every rank reads the manifests before the barrier below, so all agree
+    # on what remains before anyone commits new progress.
+    other_formats = ProgressManifest.result_formats(OUTPUT_DIR, run_id) - {RESULT_FORMAT}
+    if other_formats:
+        raise ValueError(
+            f"Run {run_id} already has {', '.join(sorted(other_formats))} results; "
+            f"resume it with the same RESULT_FORMAT or set a new RUN_ID"
+        )
+    completed = ProgressManifest.completed_indices(OUTPUT_DIR, run_id, listing)
+    remaining = np.setdiff1d(np.arange(len(dataset)), completed)
+    if global_rank == 0 and len(completed):
+        print(f"--- 🚀 Resuming run {run_id}: {len(completed)} images already done ---")
+    if SHARDING == "dynamic":
+        # Rank 0 runs on the node torchrun names in MASTER_ADDR.
+        store = create_shard_store(os.environ["MASTER_ADDR"], global_rank, "shards")
+        sampler = WorkQueueSampler(remaining, store, run_id, SHARD_CHUNK_SIZE, world_size)
+    else:
+        sampler = IndexSampler(remaining[global_rank::world_size])
+
+    if SHARDING == "dynamic":
+        print(f"Rank {global_rank}: Sampler will claim chunks of {SHARD_CHUNK_SIZE} "
+              f"from {len(remaining)} remaining images.")
+    else:
+        print(f"Rank {global_rank}: Sampler will give {len(sampler)} images to this process.")
+
+    # Decoding runs in worker processes so the main loop only feeds the GPU.
+    worker_options = {}
+    if DECODE_WORKERS > 0:
+        worker_options = dict(
+            prefetch_factor=PREFETCH_FACTOR,
+            persistent_workers=PERSISTENT_WORKERS,
+        )
     dataloader = DataLoader(
         dataset,
         batch_size=BATCH_SIZE,
         sampler=sampler, 
-        collate_fn=create_collate_fn(),
+        collate_fn=collate_fn,
         pin_memory=True, 
+        num_workers=DECODE_WORKERS,
+        **worker_options,
     )
 
     # --- 4. Run Inference and Write Sharded Results ---
     dist.barrier(device_ids=[local_rank])
 
-    timestamp = time.strftime("%Y%m%d-%H%M%S")
-    output_csv_path_shard = OUTPUT_DIR / f"results_{timestamp}_shard_{global_rank}.csv"
-
-    with torch.no_grad(), open(output_csv_path_shard, 'w', newline='') as csvfile:
-        csv_writer = csv.writer(csvfile)
-        csv_writer.writerow(['image_id', 'classification'])
+    id2label = model.config.id2label
+    labels = [id2label[i] for i in range(len(id2label))]
+    manifest = ProgressManifest(OUTPUT_DIR, run_id, global_rank, listing)
+    result_sink = create_result_sink(
+        OUTPUT_DIR / f"results_{run_id}_shard_{global_rank}", labels, manifest.state["sink"]
+    )
 
+    with inference_context(), result_sink:
         progress_bar = tqdm(dataloader, desc=f"Rank {global_rank}", disable=(global_rank != 0))
 
+        # Time blocked waiting for the next batch; a high share means the
+        # GPU is starved and DECODE_WORKERS should go up.
+        data_wait_s = 0.0
+        loop_start = fetch_start = time.perf_counter()
+        pending_indices = []
+        last_checkpoint = time.monotonic()
         for image_ids, pixel_values_batch in progress_bar:
-            pixel_values_batch = pixel_values_batch.to(local_rank, non_blocking=True)
-            with torch.autocast(device_type="cuda", dtype=torch.bfloat16):
-                outputs = model(pixel_values=pixel_values_batch)
-            predicted_class_indices = outputs.logits.argmax(-1).cpu().numpy()
-
-            id2label = model.module.config.id2label
-            rows_to_write = [
-                [image_id, id2label[class_idx]]
-                for image_id, class_idx in zip(image_ids, predicted_class_indices)
-            ]
-            csv_writer.writerows(rows_to_write)
-
-    print(f"--- ✅ Rank {global_rank} Complete. Results saved to: {output_csv_path_shard} ---")
+            data_wait_s += time.perf_counter() - fetch_start
+            pending_indices += sampler.take(len(image_ids))
+            if preprocess_fn:
+                pixel_values_batch = preprocess_fn(pixel_values_batch)
+            else:
+                pixel_values_batch = pixel_values_batch.to(local_rank, non_blocking=True)
+            logits = backend(pixel_values_batch)
+            # Only the top-k leave the GPU, not the full logits.
+            top_probs, top_ids = logits.float().softmax(-1).topk(max(TOP_K, 1), dim=-1)
+            result_sink.write(image_ids, top_ids.cpu().numpy(), top_probs.cpu().numpy())
+            if time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL_S:
+                manifest.commit(pending_indices, result_sink.checkpoint())
+                pending_indices = []
+                last_checkpoint = time.monotonic()
+            progress_bar.set_postfix(
+                data_wait=f"{data_wait_s / (time.perf_counter() - loop_start):.0%}",
+                **({"chunks": f"{sampler.chunks_done}/{sampler.num_chunks}"}
+                   if SHARDING == "dynamic" else {}),
+            )
+            fetch_start = time.perf_counter()
+
+        manifest.commit(pending_indices, result_sink.checkpoint())
+        loop_s = time.perf_counter() - loop_start
+        if SHARDING == "dynamic":
+            print(f"Rank {global_rank}: processed {sampler.chunks_claimed} of {sampler.num_chunks} chunks")
+        print(f"Rank {global_rank}: waited on data for {data_wait_s:.1f}s of {loop_s:.1f}s "
+              f"({data_wait_s / max(loop_s, 1e-9):.1%})")
+
+    print(f"--- ✅ Rank {global_rank} Complete. Results saved to: {result_sink.path} ---")
+
+    # Rank 0 hosts the shard store, so it must not exit while other ranks
+    # still claim or count chunks; merging also needs every shard committed.
+    dist.barrier(device_ids=[local_rank])
+    if RESULT_FORMAT == "parquet" and MERGE_RESULTS and global_rank == 0:
+        dataset_dir = merge_result_shards(OUTPUT_DIR, run_id)
+        print(f"--- ✅ Merged result shards into: {dataset_dir} ---")
 
 
 if __name__ == "__main__":
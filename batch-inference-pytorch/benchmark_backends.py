@@ -0,0 +1,95 @@
+# Copyright 2025 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmark of the batch inference backends on CPU.
+
+Builds a small randomly initialized ViT (or loads `--model-id`) and runs
+synthetic batches through each backend and precision that
+batch_inference.py supports, reporting images/s:
+
+    python benchmark_backends.py --backends eager,compiled,torchscript,onnx
+"""
+
+import argparse
+import time
+
+import torch
+from transformers import ViTConfig, ViTForImageClassification
+
+from batch_inference import create_backend
+
+
+def build_model(args):
+    if args.model_id:
+        return ViTForImageClassification.from_pretrained(args.model_id)
+    config = ViTConfig(
+        image_size=args.image_size,
+        hidden_size=192,
+        num_hidden_layers=4,
+        num_attention_heads=3,
+        intermediate_size=768,
+        num_labels=1000,
+    )
+    return ViTForImageClassification(config)
+
+
+def run(backend_name, precision, args):
+    device = torch.device("cpu")
+    example = torch.randn(args.batch_size, 3, args.image_size, args.image_size)
+    inference_context = torch.inference_mode if args.inference_mode else torch.no_grad
+    try:
+        backend = create_backend(
+            backend_name, build_model(args), device, precision, example, inference_context
+        )
+    except (ImportError, ValueError) as e:
+        return f"skipped ({e})"
+    # A smaller final batch, as the last batch of a shard usually is.
+    last_batch = example[:max(args.batch_size // 3, 1)]
+    with inference_context():
+        for _ in range(args.warmup):
+            backend(example)
+        start = time.perf_counter()
+        backend(last_batch)
+        last_batch_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            backend(example)
+        elapsed_s = time.perf_counter() - start
+    return (f"{args.iterations * args.batch_size / elapsed_s:9.1f} images/s  "
+            f"first smaller batch {last_batch_ms:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--backends", default="eager,compiled,torchscript,onnx")
+    parser.add_argument("--precisions", default="fp32,bf16")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--image-size", type=int, default=224)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=0, help="torch intra-op threads; 0 keeps the default.")
+    parser.add_argument("--no-inference-mode", dest="inference_mode", action="store_false")
+    parser.add_argument("--model-id", default="", help="Load this model instead of a small random ViT.")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    for backend_name in args.backends.split(","):
+        for precision in args.precisions.split(","):
+            print(f"{backend_name:12s} {precision:5s} {run(backend_name, precision, args)}")
+
+
+if __name__ == "__main__":
+    main()
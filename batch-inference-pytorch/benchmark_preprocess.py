@@ -0,0 +1,153 @@
+# Copyright 2025 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""CPU benchmark of the batch inference preprocessing modes.
+
+Generates synthetic JPEGs in memory and pushes them through the same
+dataset, collate and preprocess functions batch_inference.py uses. The
+loader columns are the work DataLoader workers do per image. The device
+column is the batched resize and normalization, which runs on the GPU in
+the job and on the CPU here:
+
+    python benchmark_preprocess.py --images 2048 --workers 0
+"""
+
+import argparse
+import io
+import random
+import time
+
+import torch
+from torch.utils.data import DataLoader
+from torchvision import transforms
+from torchvision.transforms.v2 import functional as TF
+
+from batch_inference import (
+    DataFluxWrapperDataset,
+    create_collate_fn,
+    create_preprocess_fn,
+)
+
+# ViT base input size and normalization.
+IMAGE_SIZE = (224, 224)
+MEAN = [0.5, 0.5, 0.5]
+STD = [0.5, 0.5, 0.5]
+# Typical photo sizes, as (width, height).
+SOURCE_SIZES = [(500, 375), (640, 480), (800, 600), (375, 500)]
+
+
+class InMemoryObjects:
+    """Stands in for DataFluxMapStyleDataset with pre-encoded JPEG bytes."""
+
+    def __init__(self, images):
+        self.objects = [(f"synthetic/{i}.jpg", len(data)) for i, data in enumerate(images)]
+        self.images = images
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        return self.images[idx]
+
+
+def make_jpegs(count, uniform, seed):
+    rng = random.Random(seed)
+    torch.manual_seed(seed)
+    images = []
+    for _ in range(count):
+        width, height = SOURCE_SIZES[0] if uniform else rng.choice(SOURCE_SIZES)
+        # Smooth noise upsampled from a coarse grid compresses like a photo.
+        coarse = torch.randint(0, 256, (3, height // 16, width // 16), dtype=torch.uint8)
+        pixels = TF.resize(coarse, [height, width], antialias=True)
+        buffer = io.BytesIO()
+        TF.to_pil_image(pixels).save(buffer, format="JPEG", quality=90)
+        images.append(buffer.getvalue())
+    return images
+
+
+def build(mode, objects):
+    if mode == "per_image":
+        transform = transforms.Compose([
+            transforms.Resize(IMAGE_SIZE),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=MEAN, std=STD),
+        ])
+        dataset = DataFluxWrapperDataset(objects, transform_fn=transform)
+        return dataset, create_collate_fn(), None
+    draft_size = IMAGE_SIZE[::-1] if mode == "batched_draft" else None
+    dataset = DataFluxWrapperDataset(
+        objects, transform_fn=TF.pil_to_tensor, draft_size=draft_size
+    )
+    preprocess_fn = create_preprocess_fn(MEAN, STD, IMAGE_SIZE, torch.device("cpu"))
+    return dataset, create_collate_fn(group_by_shape=True), preprocess_fn
+
+
+def run(mode, objects, args):
+    dataset, collate_fn, preprocess_fn = build(mode, objects)
+    options = {}
+    if args.workers > 0:
+        options = dict(prefetch_factor=4, persistent_workers=False)
+    dataloader = DataLoader(
+        dataset,
+        batch_size=args.batch_size,
+        collate_fn=collate_fn,
+        num_workers=args.workers,
+        **options,
+    )
+    images = 0
+    device_s = 0.0
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    for image_ids, batch in dataloader:
+        if preprocess_fn:
+            start = time.perf_counter()
+            batch = preprocess_fn(batch)
+            device_s += time.perf_counter() - start
+        images += len(image_ids)
+    loader_s = time.perf_counter() - wall_start - device_s
+    cpu_s = time.process_time() - cpu_start
+    return {
+        "mode": mode,
+        "loader_images_per_s": images / loader_s,
+        # Only the main process is counted, so this is exact for --workers 0.
+        "cpu_ms_per_image": cpu_s * 1000 / images,
+        "device_ms_per_image": device_s * 1000 / images,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--images", type=int, default=1024)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--threads", type=int, default=1, help="torch intra-op threads.")
+    parser.add_argument("--uniform", action="store_true", help="Give every image the same size.")
+    parser.add_argument("--modes", default="per_image,batched,batched_draft")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    objects = InMemoryObjects(make_jpegs(args.images, args.uniform, args.seed))
+    baseline = None
+    for mode in args.modes.split(","):
+        run(mode, InMemoryObjects(objects.images[:args.batch_size]), args)  # warm up
+        result = run(mode, objects, args)
+        baseline = baseline or result["loader_images_per_s"]
+        print(f"{mode:14s} loader {result['loader_images_per_s']:9.1f} images/s "
+              f"{result['loader_images_per_s'] / baseline:5.2f}x  "
+              f"{result['cpu_ms_per_image']:7.2f} CPU ms/image  "
+              f"device step {result['device_ms_per_image']:6.2f} ms/image")
+
+
+if __name__ == "__main__":
+    main()
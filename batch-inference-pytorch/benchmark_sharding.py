@@ -0,0 +1,126 @@
+# Copyright 2025 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Static vs. dynamic sharding on skewed synthetic workloads, on CPU.
+
+Spawns `--world-size` processes with the gloo backend. Each rank pulls
+batches from the same samplers batch_inference.py uses and sleeps for the
+simulated cost of every image. The script checks that every index was
+processed exactly once, then reports the makespan and when each rank
+finished:
+
+    python benchmark_sharding.py --world-size 8 --skew slow_rank
+"""
+
+import argparse
+import socket
+import time
+
+import numpy as np
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from batch_inference import IndexSampler, WorkQueueSampler, create_shard_store
+
+
+def item_costs(args):
+    """Per-image cost in seconds for the chosen skew."""
+    rng = np.random.default_rng(args.seed)
+    costs = np.full(args.images, args.cost_ms / 1000)
+    if args.skew == "heavy_tail":
+        # Mostly cheap images with a few very large ones.
+        costs *= rng.lognormal(mean=0, sigma=1.5, size=args.images)
+    elif args.skew == "clustered":
+        # A contiguous run of large images, e.g. one high-resolution folder.
+        start = args.images // 3
+        costs[start:start + args.images // 10] *= 10
+    return costs
+
+
+def slowdown(args, rank):
+    return args.slow_factor if args.skew == "slow_rank" and rank == 0 else 1.0
+
+
+def worker(rank, args, port, results):
+    dist.init_process_group(
+        "gloo", init_method=f"tcp://127.0.0.1:{port}", rank=rank, world_size=args.world_size
+    )
+    costs = item_costs(args)
+    indices = np.arange(args.images)
+    for mode in args.modes.split(","):
+        if mode == "dynamic":
+            store = create_shard_store("127.0.0.1", rank, f"bench/{mode}")
+            sampler = WorkQueueSampler(indices, store, "bench", args.chunk_size, args.world_size)
+        else:
+            sampler = IndexSampler(indices[rank::args.world_size])
+        dist.barrier()
+        start = time.perf_counter()
+        done = []
+        batch = []
+        for idx in sampler:
+            batch.append(idx)
+            if len(batch) == args.batch_size:
+                time.sleep(costs[batch].sum() * slowdown(args, rank))
+                done += sampler.take(len(batch))
+                batch = []
+        if batch:
+            time.sleep(costs[batch].sum() * slowdown(args, rank))
+            done += sampler.take(len(batch))
+        finished_s = time.perf_counter() - start
+        # As in batch_inference.py, rank 0 keeps the store up until all are done.
+        dist.barrier()
+        gathered = [None] * args.world_size
+        dist.all_gather_object(gathered, (finished_s, done))
+        if rank == 0:
+            results[mode] = gathered
+    dist.destroy_process_group()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--world-size", type=int, default=4)
+    parser.add_argument("--images", type=int, default=20000)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--chunk-size", type=int, default=512)
+    parser.add_argument("--cost-ms", type=float, default=0.2, help="Cost of an average image.")
+    parser.add_argument("--skew", choices=["none", "slow_rank", "heavy_tail", "clustered"], default="slow_rank")
+    parser.add_argument("--slow-factor", type=float, default=3.0, help="Slowdown of rank 0 for slow_rank.")
+    parser.add_argument("--modes", default="static,dynamic")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with mp.Manager() as manager:
+        results = manager.dict()
+        mp.spawn(worker, args=(args, free_port(), results), nprocs=args.world_size)
+        results = dict(results)
+
+    for mode, ranks in results.items():
+        processed = np.concatenate([np.asarray(done, dtype=np.int64) for _, done in ranks])
+        assert len(processed) == args.images and len(np.unique(processed)) == args.images, (
+            f"{mode}: {len(processed)} images processed, {len(np.unique(processed))} unique"
+        )
+        finish = np.array([finished_s for finished_s, _ in ranks])
+        print(f"{mode:8s} makespan {finish.max():7.2f}s  mean finish {finish.mean():7.2f}s  "
+              f"max/mean {finish.max() / finish.mean():5.2f}  "
+              f"images per rank {[len(done) for _, done in ranks]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Stand-in JetStream Orchestrator that emits synthetic tokens without a TPU."""
+
+import argparse
+import asyncio
+import logging
+
+import grpc
+from jetstream.core.proto import jetstream_pb2
+from jetstream.core.proto import jetstream_pb2_grpc
+
+
+class FakeOrchestrator(jetstream_pb2_grpc.OrchestratorServicer):
+  """Answers Decode with `output_tokens` tokens spaced `token_delay_ms` apart.
+
+  `prefill_ms` is added before the first token to mimic prefill. The number
+  of tokens is capped by the request's max_tokens.
+  """
+
+  def __init__(self, output_tokens: int, token_delay_ms: float, prefill_ms: float):
+    self._output_tokens = output_tokens
+    self._token_delay_s = token_delay_ms / 1000
+    self._prefill_s = prefill_ms / 1000
+
+  async def Decode(self, request, context):
+    tokens = self._output_tokens
+    if request.max_tokens > 0:
+      tokens = min(tokens, request.max_tokens)
+    if self._prefill_s:
+      await asyncio.sleep(self._prefill_s)
+    for i in range(tokens):
+      if i and self._token_delay_s:
+        await asyncio.sleep(self._token_delay_s)
+      sample = jetstream_pb2.DecodeResponse.StreamContent.Sample(
+          text=f" tok{i}", token_ids=[i]
+      )
+      yield jetstream_pb2.DecodeResponse(
+          stream_content=jetstream_pb2.DecodeResponse.StreamContent(
+              samples=[sample]
+          )
+      )
+
+  async def HealthCheck(self, request, context):
+    return jetstream_pb2.HealthCheckResponse(is_live=True)
+
+
+async def serve(port: int, output_tokens: int, token_delay_ms: float, prefill_ms: float):
+  server = grpc.aio.server()
+  jetstream_pb2_grpc.add_OrchestratorServicer_to_server(
+      FakeOrchestrator(output_tokens, token_delay_ms, prefill_ms), server
+  )
+  server.add_insecure_port(f"127.0.0.1:{port}")
+  await server.start()
+  logging.info("Fake orchestrator listening on 127.0.0.1:%d", port)
+  await server.wait_for_termination()
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--port", type=int, default=9000)
+  parser.add_argument("--output-tokens", type=int, default=128)
+  parser.add_argument("--token-delay-ms", type=float, default=10.0)
+  parser.add_argument("--prefill-ms", type=float, default=50.0)
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO)
+  asyncio.run(
+      serve(args.port, args.output_tokens, args.token_delay_ms, args.prefill_ms)
+  )
+
+
+if __name__ == "__main__":
+  main()
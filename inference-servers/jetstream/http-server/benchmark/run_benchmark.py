@@ -0,0 +1,225 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Open-loop load test of the JetStream HTTP server against a fake orchestrator.
+
+Starts `fake_orchestrator.py` and `http_server.py` as subprocesses, drives
+`/generate` at a fixed or Poisson arrival rate and reports latency
+percentiles, time to first token, throughput and the HTTP server's CPU time
+per request for each mode.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import httpx
+import psutil
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+HTTP_SERVER_DIR = os.path.dirname(BENCHMARK_DIR)
+
+
+def percentile(values, q):
+  if not values:
+    return float("nan")
+  values = sorted(values)
+  index = min(len(values) - 1, max(0, round(q / 100 * (len(values) - 1))))
+  return values[index]
+
+
+class Result:
+  __slots__ = ("status", "latency_s", "ttft_s", "bytes")
+
+  def __init__(self):
+    self.status = None
+    self.latency_s = None
+    self.ttft_s = None
+    self.bytes = 0
+
+
+async def send(
+    client: httpx.AsyncClient, url: str, payload, stream: bool, start: float
+):
+  """Sends one request; latencies count from its scheduled send time."""
+  result = Result()
+  try:
+    if stream:
+      async with client.stream("POST", url, json=payload) as response:
+        result.status = response.status_code
+        async for chunk in response.aiter_raw():
+          if result.ttft_s is None:
+            result.ttft_s = time.perf_counter() - start
+          result.bytes += len(chunk)
+    else:
+      response = await client.post(url, json=payload)
+      result.status = response.status_code
+      result.bytes = len(response.content)
+  except httpx.HTTPError:
+    result.status = -1
+  result.latency_s = time.perf_counter() - start
+  if result.ttft_s is None:
+    result.ttft_s = result.latency_s
+  return result
+
+
+async def run_load(args, mode: str, server_process: psutil.Process):
+  """Sends requests on an open-loop schedule and summarizes the results."""
+  stream = mode != "unary"
+  payload = {
+      "prompt": args.prompt,
+      "max_tokens": args.max_tokens,
+      "stream": stream,
+      "server": "127.0.0.1",
+      "port": str(args.grpc_port),
+  }
+  if stream:
+    payload["stream_format"] = mode
+  url = f"http://127.0.0.1:{args.http_port}/generate"
+  limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+  timeout = httpx.Timeout(args.request_timeout_s)
+  rng = random.Random(args.seed)
+
+  async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+    tasks = []
+    cpu_start = server_process.cpu_times()
+    start = time.perf_counter()
+    next_send = start
+    while next_send - start < args.duration_s:
+      delay = next_send - time.perf_counter()
+      if delay > 0:
+        await asyncio.sleep(delay)
+      tasks.append(
+          asyncio.create_task(send(client, url, payload, stream, next_send))
+      )
+      if args.arrival == "poisson":
+        next_send += rng.expovariate(args.qps)
+      else:
+        next_send += 1 / args.qps
+    results = await asyncio.gather(*tasks)
+    elapsed_s = time.perf_counter() - start
+    cpu_end = server_process.cpu_times()
+
+  ok = [r for r in results if r.status == 200]
+  cpu_s = (cpu_end.user - cpu_start.user) + (cpu_end.system - cpu_start.system)
+  tokens = min(args.max_tokens, args.output_tokens) * len(ok)
+  latencies = [r.latency_s * 1000 for r in ok]
+  ttfts = [r.ttft_s * 1000 for r in ok]
+  return {
+      "mode": mode,
+      "arrival": args.arrival,
+      "target_qps": args.qps,
+      "sent": len(results),
+      "ok": len(ok),
+      "errors": len(results) - len(ok),
+      "achieved_qps": len(ok) / elapsed_s,
+      "tokens_per_s": tokens / elapsed_s,
+      "latency_ms_p50": percentile(latencies, 50),
+      "latency_ms_p95": percentile(latencies, 95),
+      "latency_ms_p99": percentile(latencies, 99),
+      "ttft_ms_p50": percentile(ttfts, 50),
+      "ttft_ms_p95": percentile(ttfts, 95),
+      "ttft_ms_p99": percentile(ttfts, 99),
+      "server_cpu_ms_per_request": cpu_s * 1000 / max(1, len(results)),
+      "bytes_per_request": sum(r.bytes for r in ok) / max(1, len(ok)),
+  }
+
+
+def wait_until_ready(port: int, timeout_s: float):
+  deadline = time.monotonic() + timeout_s
+  while time.monotonic() < deadline:
+    try:
+      if httpx.get(f"http://127.0.0.1:{port}/ready").status_code == 200:
+        return
+    except httpx.HTTPError:
+      pass
+    time.sleep(0.2)
+  raise RuntimeError(f"HTTP server on port {port} did not become ready")
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument(
+      "--modes",
+      default="unary,ndjson",
+      help="Comma separated list of unary, json, sse and ndjson.",
+  )
+  parser.add_argument("--qps", type=float, default=20.0)
+  parser.add_argument("--arrival", choices=["constant", "poisson"], default="poisson")
+  parser.add_argument("--duration-s", type=float, default=30.0)
+  parser.add_argument("--warmup-s", type=float, default=3.0)
+  parser.add_argument("--prompt", default="This is an example prompt")
+  parser.add_argument("--max-tokens", type=int, default=128)
+  parser.add_argument("--output-tokens", type=int, default=128)
+  parser.add_argument("--token-delay-ms", type=float, default=10.0)
+  parser.add_argument("--prefill-ms", type=float, default=50.0)
+  parser.add_argument("--request-timeout-s", type=float, default=120.0)
+  parser.add_argument("--http-port", type=int, default=8000)
+  parser.add_argument("--grpc-port", type=int, default=9000)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--json", action="store_true", help="Print results as JSON.")
+  args = parser.parse_args()
+
+  env = dict(os.environ, JETSTREAM_GRPC_PORT=str(args.grpc_port))
+  orchestrator = subprocess.Popen([
+      sys.executable,
+      os.path.join(BENCHMARK_DIR, "fake_orchestrator.py"),
+      f"--port={args.grpc_port}",
+      f"--output-tokens={args.output_tokens}",
+      f"--token-delay-ms={args.token_delay_ms}",
+      f"--prefill-ms={args.prefill_ms}",
+  ])
+  server = subprocess.Popen(
+      [
+          sys.executable, "-m", "uvicorn", "http_server:app",
+          "--host=127.0.0.1", f"--port={args.http_port}",
+          "--log-level=warning", "--no-access-log",
+      ],
+      cwd=HTTP_SERVER_DIR,
+      env=env,
+  )
+  try:
+    wait_until_ready(args.http_port, timeout_s=60)
+    server_process = psutil.Process(server.pid)
+    reports = []
+    for mode in args.modes.split(","):
+      if args.warmup_s:
+        warmup = argparse.Namespace(**vars(args))
+        warmup.duration_s = args.warmup_s
+        asyncio.run(run_load(warmup, mode, server_process))
+      reports.append(asyncio.run(run_load(args, mode, server_process)))
+  finally:
+    server.terminate()
+    orchestrator.terminate()
+    server.wait()
+    orchestrator.wait()
+
+  if args.json:
+    print(json.dumps(reports, indent=2))
+    return
+  for report in reports:
+    print(f"--- {report['mode']} ---")
+    for key, value in report.items():
+      if isinstance(value, float):
+        value = f"{value:.2f}"
+      print(f"  {key:28s} {value}")
+
+
+if __name__ == "__main__":
+  main()
@@ -15,11 +15,15 @@
 """HTTP Server to interact with JetStream Server."""
 
 import asyncio
-import concurrent.futures
+import collections
+import contextlib
+import heapq
+import itertools
 import json
 import logging
+import os
 import time
-from typing import Optional
+from typing import List, Literal, Optional
 import uuid
 
 import fastapi
@@ -27,21 +31,881 @@ from fastapi.responses import StreamingResponse
 import grpc
 from jetstream.core.proto import jetstream_pb2
 from jetstream.core.proto import jetstream_pb2_grpc
+import prometheus_client
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 import pydantic
 
 
+# Default orchestrator address, used for health checks and as the default
+# server/port of generate requests.
+GRPC_SERVER = os.getenv("JETSTREAM_GRPC_SERVER", "127.0.0.1")
+GRPC_PORT = os.getenv("JETSTREAM_GRPC_PORT", "9000")
+GRPC_TARGET = f"{GRPC_SERVER}:{GRPC_PORT}"
+# Number of long-lived channels opened per upstream target.
+GRPC_CHANNELS_PER_TARGET = int(os.getenv("JETSTREAM_GRPC_CHANNELS_PER_TARGET", "4"))
+# Comma separated host:port targets that requests may select through
+# server/port; any other target is rejected with 403.
+GRPC_ALLOWED_TARGETS = frozenset(
+    t.strip()
+    for t in os.getenv("JETSTREAM_GRPC_ALLOWED_TARGETS", GRPC_TARGET).split(",")
+    if t.strip()
+) | {GRPC_TARGET}
+# Upper bound on distinct upstream targets with open channels. Targets unused
+# for GRPC_TARGET_IDLE_S, or whose channels all failed, are closed to make
+# room for new ones.
+GRPC_MAX_TARGETS = int(os.getenv("JETSTREAM_GRPC_MAX_TARGETS", "8"))
+GRPC_TARGET_IDLE_S = float(os.getenv("JETSTREAM_GRPC_TARGET_IDLE_S", "300"))
+GRPC_KEEPALIVE_TIME_MS = int(os.getenv("JETSTREAM_GRPC_KEEPALIVE_TIME_MS", "30000"))
+GRPC_KEEPALIVE_TIMEOUT_MS = int(os.getenv("JETSTREAM_GRPC_KEEPALIVE_TIMEOUT_MS", "10000"))
+
+# Maximum number of non-streaming Decode calls in flight to the orchestrator.
+MAX_INFLIGHT = int(os.getenv("JETSTREAM_MAX_INFLIGHT", "256"))
+# Maximum number of requests waiting for an in-flight slot before new ones
+# are rejected with 429.
+MAX_QUEUE = int(os.getenv("JETSTREAM_MAX_QUEUE", "1024"))
+# Retry-After value, in seconds, sent with 429 responses.
+RETRY_AFTER_S = int(os.getenv("JETSTREAM_RETRY_AFTER_S", "1"))
+
+# Default token coalescing for sse/ndjson streams: a frame is flushed once
+# this many tokens or this many milliseconds have accumulated (0 disables
+# the respective limit; with both disabled every token is flushed).
+STREAM_FLUSH_TOKENS = int(os.getenv("JETSTREAM_STREAM_FLUSH_TOKENS", "0"))
+STREAM_FLUSH_MS = int(os.getenv("JETSTREAM_STREAM_FLUSH_MS", "0"))
+
+# Byte budget of the exact-match completion cache; 0 disables both the cache
+# and the merging of identical in-flight requests.
+CACHE_MAX_BYTES = int(os.getenv("JETSTREAM_CACHE_MAX_BYTES", "0"))
+CACHE_TTL_S = float(os.getenv("JETSTREAM_CACHE_TTL_S", "60"))
+
+# Default and maximum number of concurrently decoded items per batch call.
+BATCH_CONCURRENCY = int(os.getenv("JETSTREAM_BATCH_CONCURRENCY", "64"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("JETSTREAM_BATCH_MAX_CONCURRENCY", "256"))
+BATCH_MAX_ITEMS = int(os.getenv("JETSTREAM_BATCH_MAX_ITEMS", "100000"))
+
+# Server-side deadline applied to requests that do not set their own through
+# the timeout_ms field or the X-Request-Timeout-Ms header; 0 means none.
+REQUEST_TIMEOUT_MS = int(os.getenv("JETSTREAM_REQUEST_TIMEOUT_MS", "0"))
+# How often a waiting non-streaming request checks for a client disconnect.
+DISCONNECT_POLL_MS = int(os.getenv("JETSTREAM_DISCONNECT_POLL_MS", "250"))
+
+# Background HealthCheck probing; /healthcheck fails once the last result is
+# older than the staleness bound.
+HEALTH_INTERVAL_S = float(os.getenv("JETSTREAM_HEALTH_INTERVAL_S", "2"))
+HEALTH_TIMEOUT_S = float(os.getenv("JETSTREAM_HEALTH_TIMEOUT_S", "5"))
+HEALTH_MAX_STALENESS_S = float(os.getenv("JETSTREAM_HEALTH_MAX_STALENESS_S", "10"))
+# /ready fails while the admission queue is at least this fraction full.
+READY_MAX_QUEUE_FRACTION = float(
+    os.getenv("JETSTREAM_READY_MAX_QUEUE_FRACTION", "0.9")
+)
+
+GRPC_OPTIONS = [
+    ("grpc.keepalive_time_ms", GRPC_KEEPALIVE_TIME_MS),
+    ("grpc.keepalive_timeout_ms", GRPC_KEEPALIVE_TIMEOUT_MS),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+    ("grpc.initial_reconnect_backoff_ms", 100),
+    ("grpc.max_reconnect_backoff_ms", 5000),
+    # Without a local subchannel pool, channels with identical arguments share
+    # one global subchannel and therefore a single TCP connection.
+    ("grpc.use_local_subchannel_pool", 1),
+]
+
+
+TTFT_SECONDS = prometheus_client.Histogram(
+    "jetstream_http_time_to_first_token_seconds",
+    "Time from sending a Decode call to receiving its first token.",
+    ["mode"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+INTER_TOKEN_SECONDS = prometheus_client.Histogram(
+    "jetstream_http_inter_token_latency_seconds",
+    "Time between consecutive tokens of a Decode call.",
+    ["mode"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.02, 0.04, 0.08, 0.16, 0.32, 0.64, 1.28),
+)
+REQUEST_SECONDS = prometheus_client.Histogram(
+    "jetstream_http_request_latency_seconds",
+    "Time from sending a Decode call to receiving its last token.",
+    ["mode"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160),
+)
+OUTPUT_TOKENS = prometheus_client.Histogram(
+    "jetstream_http_output_tokens",
+    "Number of tokens returned per request.",
+    ["mode"],
+    buckets=(1, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096),
+)
+QUEUE_WAIT_SECONDS = prometheus_client.Histogram(
+    "jetstream_http_queue_wait_seconds",
+    "Time spent waiting for an admission slot.",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+REQUESTS_IN_FLIGHT = prometheus_client.Gauge(
+    "jetstream_http_requests_in_flight",
+    "Generations currently receiving tokens.",
+    ["mode"],
+)
+
+
+class RequestTimer:
+  """Records the latency metrics of one generation.
+
+  Label children are resolved once per mode, so the per-token cost is a
+  clock read and one histogram observation.
+  """
+
+  __slots__ = ("_ttft", "_itl", "_latency", "_tokens", "_inflight",
+               "start", "last", "tokens")
+
+  _children = {}
+
+  def __init__(self, mode: str):
+    children = self._children.get(mode)
+    if children is None:
+      children = self._children[mode] = (
+          TTFT_SECONDS.labels(mode),
+          INTER_TOKEN_SECONDS.labels(mode),
+          REQUEST_SECONDS.labels(mode),
+          OUTPUT_TOKENS.labels(mode),
+          REQUESTS_IN_FLIGHT.labels(mode),
+      )
+    (self._ttft, self._itl, self._latency, self._tokens,
+     self._inflight) = children
+    self._inflight.inc()
+    self.start = time.perf_counter()
+    self.last = None
+    self.tokens = 0
+
+  def token(self):
+    now = time.perf_counter()
+    if self.last is None:
+      self._ttft.observe(now - self.start)
+    else:
+      self._itl.observe(now - self.last)
+    self.last = now
+    self.tokens += 1
+
+  def finish(self):
+    self._latency.observe(time.perf_counter() - self.start)
+    self._tokens.observe(self.tokens)
+    self._inflight.dec()
+
+
+class _PooledChannel:
+  """A long-lived channel to one upstream and its Orchestrator stub."""
+
+  def __init__(self, target: str, options):
+    self.channel = grpc.aio.insecure_channel(target, options=options)
+    self.stub = jetstream_pb2_grpc.OrchestratorStub(self.channel)
+    self.calls = 0
+
+
+class ChannelPool:
+  """Round-robin pool of persistent gRPC channels, keyed by upstream target.
+
+  Only targets in `allowed_targets` can be opened, so clients cannot make the
+  server connect to arbitrary hosts. Channels are opened lazily on first use
+  of a target (or eagerly through `connect`). When `max_targets` are open,
+  a target with no calls in flight that has been idle for `idle_s` since its
+  last call ended, or whose channels all failed, is closed to make room;
+  `pinned` targets are never closed before shutdown.
+  gRPC reconnects broken channels on its own; channels that were shut down
+  are replaced.
+  """
+
+  _FAILED_STATES = (
+      grpc.ChannelConnectivity.TRANSIENT_FAILURE,
+      grpc.ChannelConnectivity.SHUTDOWN,
+  )
+
+  def __init__(
+      self,
+      size: int,
+      max_targets: int,
+      options,
+      allowed_targets,
+      idle_s: float,
+      pinned=(),
+  ):
+    self._size = max(1, size)
+    self._max_targets = max_targets
+    self._options = options
+    self._allowed_targets = frozenset(allowed_targets)
+    self._idle_s = idle_s
+    self._pinned = frozenset(pinned)
+    self._channels = {}
+    self._next = {}
+    self._last_used = {}
+    self._active = collections.Counter()
+    self._closing = set()
+    self.evictions = 0
+
+  def _evictable(self, target: str, now: float) -> bool:
+    if target in self._pinned or self._active[target]:
+      return False
+    if now - self._last_used[target] >= self._idle_s:
+      return True
+    return all(
+        p.channel.get_state() in self._FAILED_STATES
+        for p in self._channels[target]
+    )
+
+  def _evict_one(self) -> bool:
+    """Closes the least recently used evictable target, if there is one."""
+    now = time.monotonic()
+    candidates = [t for t in self._channels if self._evictable(t, now)]
+    if not candidates:
+      return False
+    target = min(candidates, key=self._last_used.get)
+    channels = self._channels.pop(target)
+    del self._next[target]
+    del self._last_used[target]
+    self.evictions += 1
+    logging.info("Closing channels to upstream %s", target)
+    for pooled in channels:
+      task = asyncio.get_running_loop().create_task(pooled.channel.close())
+      self._closing.add(task)
+      task.add_done_callback(self._closing.discard)
+    return True
+
+  def connect(self, target: str):
+    """Opens the channels for `target` and asks them to connect now."""
+    channels = self._channels.get(target)
+    if channels is None:
+      if target not in self._allowed_targets:
+        raise fastapi.HTTPException(
+            status_code=403,
+            detail=f"Upstream target {target} is not allowed",
+        )
+      if len(self._channels) >= self._max_targets and not self._evict_one():
+        raise fastapi.HTTPException(
+            status_code=503,
+            detail=f"Too many active upstream targets, limit is {self._max_targets}",
+            headers={"Retry-After": str(RETRY_AFTER_S)},
+        )
+      channels = [
+          _PooledChannel(target, self._options) for _ in range(self._size)
+      ]
+      self._channels[target] = channels
+      self._next[target] = 0
+      for pooled in channels:
+        pooled.channel.get_state(try_to_connect=True)
+    self._last_used[target] = time.monotonic()
+    return channels
+
+  def stub(self, target: str = GRPC_TARGET):
+    """Returns the Orchestrator stub of the next channel for `target`."""
+    channels = self.connect(target)
+    index = self._next[target]
+    self._next[target] = (index + 1) % len(channels)
+    pooled = channels[index]
+    if pooled.channel.get_state() == grpc.ChannelConnectivity.SHUTDOWN:
+      pooled = channels[index] = _PooledChannel(target, self._options)
+    pooled.calls += 1
+    return pooled.stub
+
+  @contextlib.contextmanager
+  def call(self, target: str = GRPC_TARGET):
+    """Like `stub`, but keeps `target` open until the block exits."""
+    stub = self.stub(target)
+    self._active[target] += 1
+    try:
+      yield stub
+    finally:
+      self._active[target] -= 1
+      if not self._active[target]:
+        del self._active[target]
+      if target in self._last_used:
+        self._last_used[target] = time.monotonic()
+
+  async def close(self):
+    channels = [p.channel for c in self._channels.values() for p in c]
+    self._channels.clear()
+    self._next.clear()
+    self._last_used.clear()
+    await asyncio.gather(
+        *(c.close() for c in channels), *self._closing, return_exceptions=True
+    )
+
+  def stats(self):
+    stats = {}
+    for target, channels in self._channels.items():
+      states = collections.Counter(
+          p.channel.get_state().name for p in channels
+      )
+      stats[target] = {
+          "channels": len(channels),
+          "calls": sum(p.calls for p in channels),
+          "active_calls": self._active[target],
+          "states": dict(states),
+      }
+    return stats
+
+
+class QueueFullError(Exception):
+  """Raised when the admission queue has no room for another request."""
+
+
+class DeadlineExceededError(Exception):
+  """Raised when a request runs past its server-side deadline."""
+
+  def __init__(self):
+    super().__init__("Deadline exceeded")
+
+
+class ClientDisconnectedError(Exception):
+  """Raised when the HTTP client went away before its response was ready."""
+
+  def __init__(self):
+    super().__init__("Client disconnected")
+
+
+# Requests whose upstream work was abandoned, by reason.
+request_counters = collections.Counter(cancelled=0, deadline_exceeded=0)
+
+
+def deadline_after(timeout_ms: Optional[int]) -> Optional[float]:
+  """Converts a relative timeout into an absolute event loop deadline."""
+  if not timeout_ms or timeout_ms <= 0:
+    return None
+  return asyncio.get_running_loop().time() + timeout_ms / 1000
+
+
+class QueueReservation:
+  """Queue places held for a batch call until released or garbage collected.
+
+  Releasing on collection covers streamed responses whose body generator is
+  dropped without ever running.
+  """
+
+  def __init__(self, admission, places: int):
+    self._admission = admission
+    self.places = places
+
+  def release(self):
+    if self.places:
+      self._admission._reserved -= self.places
+      self.places = 0
+
+  def __del__(self):
+    self.release()
+
+
+class AdmissionController:
+  """Bounds in-flight upstream calls and queues the excess by priority.
+
+  Requests with a higher `priority` value are admitted first; requests of
+  equal priority are admitted in arrival order. A released slot is handed
+  directly to the next waiter, so the in-flight count never overshoots.
+  Batch calls reserve queue places up front for all the items they may
+  have waiting at once, so they count against `max_queue` too.
+  """
+
+  def __init__(self, max_inflight: int, max_queue: int):
+    self._max_inflight = max(1, max_inflight)
+    self._max_queue = max_queue
+    self._inflight = 0
+    self._waiters = []
+    self._seq = itertools.count()
+    # Places reserved by batch calls, and how many of their items are
+    # currently among the waiters.
+    self._reserved = 0
+    self._reserved_waiting = 0
+    self.admitted = 0
+    self.rejected = 0
+    self.wait_time_s = 0.0
+    self.max_wait_time_s = 0.0
+
+  @property
+  def inflight(self) -> int:
+    return self._inflight
+
+  @property
+  def queue_depth(self) -> int:
+    return len(self._waiters)
+
+  def _occupied(self) -> int:
+    """Queue places taken by unreserved waiters and by reservations."""
+    return len(self._waiters) - self._reserved_waiting + self._reserved
+
+  def reserve(self, places: int) -> QueueReservation:
+    """Reserves `places` queue places; raises QueueFullError if they don't fit."""
+    if self._occupied() + places > self._max_queue:
+      self.rejected += 1
+      raise QueueFullError("Too many requests queued")
+    self._reserved += places
+    return QueueReservation(self, places)
+
+  async def _acquire(self, priority: int, shed: bool):
+    if self._inflight < self._max_inflight and not self._waiters:
+      self._inflight += 1
+      return
+    if shed and self._occupied() >= self._max_queue:
+      self.rejected += 1
+      raise QueueFullError("Too many requests queued")
+    waiter = asyncio.get_running_loop().create_future()
+    entry = (-priority, next(self._seq), waiter)
+    heapq.heappush(self._waiters, entry)
+    if not shed:
+      self._reserved_waiting += 1
+    try:
+      await waiter
+    except asyncio.CancelledError:
+      if waiter.done() and not waiter.cancelled():
+        # The slot was handed over just before cancellation; pass it on.
+        self._release()
+      elif entry in self._waiters:
+        self._waiters.remove(entry)
+        heapq.heapify(self._waiters)
+      raise
+    finally:
+      if not shed:
+        self._reserved_waiting -= 1
+
+  def _release(self):
+    while self._waiters:
+      _, _, waiter = heapq.heappop(self._waiters)
+      if not waiter.done():
+        waiter.set_result(None)
+        return
+    self._inflight -= 1
+
+  @contextlib.asynccontextmanager
+  async def slot(self, priority: int = 0, shed: bool = True):
+    """Holds one in-flight slot for the duration of the block.
+
+    With `shed` unset the request waits even when the queue is full; only
+    callers holding a `reserve` reservation for it, such as batch items,
+    may use this.
+    """
+    start = time.perf_counter()
+    await self._acquire(priority or 0, shed)
+    waited = time.perf_counter() - start
+    QUEUE_WAIT_SECONDS.observe(waited)
+    self.admitted += 1
+    self.wait_time_s += waited
+    self.max_wait_time_s = max(self.max_wait_time_s, waited)
+    try:
+      yield waited
+    finally:
+      self._release()
+
+  def stats(self):
+    return {
+        "inflight": self._inflight,
+        "max_inflight": self._max_inflight,
+        "queue_depth": len(self._waiters),
+        "max_queue": self._max_queue,
+        "reserved": self._reserved,
+        "admitted": self.admitted,
+        "rejected": self.rejected,
+        "avg_wait_s": self.wait_time_s / self.admitted if self.admitted else 0.0,
+        "max_wait_s": self.max_wait_time_s,
+    }
+
+
+class _Flight:
+  """A single Decode call whose tokens are fanned out to every subscriber."""
+
+  def __init__(self):
+    self.tokens = []
+    self.done = False
+    self.error = None
+    self.subscribers = 0
+    self.task = None
+    self._changed = asyncio.Event()
+
+  def publish(self, token: str):
+    self.tokens.append(token)
+    self._wake()
+
+  def finish(self, error: Optional[BaseException] = None):
+    self.done = True
+    self.error = error
+    self._wake()
+
+  def _wake(self):
+    self._changed.set()
+    self._changed = asyncio.Event()
+
+  async def follow(self, deadline: Optional[float] = None):
+    """Yields every token published so far, then new ones as they arrive."""
+    loop = asyncio.get_running_loop()
+    index = 0
+    while True:
+      while index < len(self.tokens):
+        yield self.tokens[index]
+        index += 1
+      if self.done:
+        if self.error is not None:
+          raise self.error
+        return
+      if deadline is None:
+        await self._changed.wait()
+        continue
+      remaining = deadline - loop.time()
+      if remaining <= 0:
+        raise DeadlineExceededError()
+      try:
+        await asyncio.wait_for(self._changed.wait(), remaining)
+      except asyncio.TimeoutError:
+        raise DeadlineExceededError() from None
+
+
+class CompletionCache:
+  """LRU+TTL cache of decoded text with single-flight request merging.
+
+  Entries are keyed on the upstream target and the DecodeRequest fields
+  that determine the output (session cache, prompt and max tokens). While a
+  key is being decoded, identical requests subscribe to the running call
+  instead of issuing their own; the call is cancelled once every subscriber
+  has gone away. Because a shared call outlives any one request, it runs
+  without a gRPC deadline and each subscriber enforces its own instead.
+  """
+
+  def __init__(self, max_bytes: int, ttl_s: float):
+    self._max_bytes = max_bytes
+    self._ttl_s = ttl_s
+    self._entries = collections.OrderedDict()
+    self._bytes = 0
+    self._flights = {}
+    self.hits = 0
+    self.misses = 0
+    self.merged = 0
+    self.evictions = 0
+
+  @property
+  def enabled(self) -> bool:
+    return self._max_bytes > 0
+
+  @staticmethod
+  def key(request: jetstream_pb2.DecodeRequest, target: str):
+    return (
+        target,
+        request.session_cache,
+        request.text_content.text,
+        request.max_tokens,
+    )
+
+  def in_flight(self, key) -> bool:
+    """Whether a running call for `key` would serve a new request."""
+    flight = self._flights.get(key)
+    return flight is not None and not flight.done
+
+  def get(self, key) -> Optional[str]:
+    entry = self._entries.get(key)
+    if entry is None:
+      return None
+    text, expires_at, size = entry
+    if time.monotonic() >= expires_at:
+      del self._entries[key]
+      self._bytes -= size
+      return None
+    self._entries.move_to_end(key)
+    self.hits += 1
+    return text
+
+  def put(self, key, text: str):
+    size = len(text.encode()) + len(key[1].encode()) + len(key[2].encode())
+    if size > self._max_bytes:
+      return
+    old = self._entries.pop(key, None)
+    if old is not None:
+      self._bytes -= old[2]
+    while self._bytes + size > self._max_bytes:
+      _, (_, _, evicted) = self._entries.popitem(last=False)
+      self._bytes -= evicted
+      self.evictions += 1
+    self._entries[key] = (text, time.monotonic() + self._ttl_s, size)
+    self._bytes += size
+
+  async def tokens(
+      self,
+      request: jetstream_pb2.DecodeRequest,
+      target: str,
+      deadline: Optional[float] = None,
+  ):
+    """Yields the tokens for `request` from the cache or a shared call."""
+    if not self.enabled:
+      async for token in decode_tokens(request, target, deadline):
+        yield token
+      return
+
+    key = self.key(request, target)
+    text = self.get(key)
+    if text is not None:
+      yield text
+      return
+
+    flight = self._flights.get(key)
+    if flight is None:
+      self.misses += 1
+      flight = self._flights[key] = _Flight()
+      flight.task = asyncio.create_task(
+          self._run(key, flight, decode_tokens(request, target))
+      )
+    else:
+      self.merged += 1
+    flight.subscribers += 1
+    try:
+      async for token in flight.follow(deadline):
+        yield token
+    finally:
+      flight.subscribers -= 1
+      if flight.subscribers == 0 and not flight.done:
+        flight.task.cancel()
+        if self._flights.get(key) is flight:
+          del self._flights[key]
+
+  async def _run(self, key, flight: _Flight, tokens):
+    try:
+      async for token in tokens:
+        flight.publish(token)
+    except BaseException as e:
+      flight.finish(e)
+      if isinstance(e, asyncio.CancelledError):
+        raise
+    else:
+      flight.finish()
+      self.put(key, "".join(flight.tokens))
+    finally:
+      if self._flights.get(key) is flight:
+        del self._flights[key]
+
+  def stats(self):
+    return {
+        "enabled": self.enabled,
+        "entries": len(self._entries),
+        "bytes": self._bytes,
+        "max_bytes": self._max_bytes,
+        "hits": self.hits,
+        "misses": self.misses,
+        "merged": self.merged,
+        "evictions": self.evictions,
+        "inflight": len(self._flights),
+    }
+
+
+class HealthProber:
+  """Probes the orchestrator's HealthCheck on an interval and caches it.
+
+  Probes go over the pooled channels, so they also exercise every channel
+  in turn. A probe that fails or times out records the upstream as not
+  live; a result older than `max_staleness_s` counts as unhealthy.
+  """
+
+  def __init__(
+      self,
+      target: str,
+      interval_s: float,
+      timeout_s: float,
+      max_staleness_s: float,
+  ):
+    self._target = target
+    self._interval_s = interval_s
+    self._timeout_s = timeout_s
+    self._max_staleness_s = max_staleness_s
+    self._task = None
+    self.is_live = False
+    self.checked_at = None
+    self.error = None
+    self.probes = 0
+    self.failures = 0
+
+  def start(self):
+    self._task = asyncio.create_task(self._run())
+
+  async def stop(self):
+    if self._task is not None:
+      self._task.cancel()
+      with contextlib.suppress(asyncio.CancelledError):
+        await self._task
+      self._task = None
+
+  async def probe(self):
+    self.probes += 1
+    try:
+      with channel_pool.call(self._target) as stub:
+        response = await stub.HealthCheck(
+            jetstream_pb2.HealthCheckRequest(), timeout=self._timeout_s
+        )
+      self.is_live = response.is_live
+      self.error = None if response.is_live else "is_live = False"
+    except Exception as e:
+      self.is_live = False
+      self.error = str(e) or type(e).__name__
+    if not self.is_live:
+      self.failures += 1
+    self.checked_at = time.monotonic()
+
+  async def _run(self):
+    while True:
+      await self.probe()
+      await asyncio.sleep(self._interval_s)
+
+  def age_s(self) -> Optional[float]:
+    if self.checked_at is None:
+      return None
+    return time.monotonic() - self.checked_at
+
+  def healthy(self) -> bool:
+    age_s = self.age_s()
+    return self.is_live and age_s is not None and age_s <= self._max_staleness_s
+
+  def stats(self):
+    return {
+        "is_live": self.is_live,
+        "healthy": self.healthy(),
+        "age_s": self.age_s(),
+        "error": self.error,
+        "probes": self.probes,
+        "failures": self.failures,
+    }
+
+
+channel_pool = ChannelPool(
+    GRPC_CHANNELS_PER_TARGET,
+    GRPC_MAX_TARGETS,
+    GRPC_OPTIONS,
+    GRPC_ALLOWED_TARGETS,
+    GRPC_TARGET_IDLE_S,
+    pinned=[GRPC_TARGET],
+)
+admission = AdmissionController(MAX_INFLIGHT, MAX_QUEUE)
+completion_cache = CompletionCache(CACHE_MAX_BYTES, CACHE_TTL_S)
+health_prober = HealthProber(
+    GRPC_TARGET, HEALTH_INTERVAL_S, HEALTH_TIMEOUT_S, HEALTH_MAX_STALENESS_S
+)
+
+
+class _StatsCollector:
+  """Exports pool, admission, cache and cancellation stats at scrape time."""
+
+  def collect(self):
+    channels = GaugeMetricFamily(
+        "jetstream_http_upstream_channels",
+        "Pooled gRPC channels by upstream target and connectivity state.",
+        labels=["target", "state"],
+    )
+    for target, stats in channel_pool.stats().items():
+      for state, count in stats["states"].items():
+        channels.add_metric([target, state], count)
+    yield channels
+
+    stats = admission.stats()
+    yield GaugeMetricFamily(
+        "jetstream_http_admission_inflight",
+        "Decode calls holding an admission slot.",
+        value=stats["inflight"],
+    )
+    yield GaugeMetricFamily(
+        "jetstream_http_admission_queue_depth",
+        "Requests waiting for an admission slot.",
+        value=stats["queue_depth"],
+    )
+    yield CounterMetricFamily(
+        "jetstream_http_admission_rejected",
+        "Requests rejected with 429 because the queue was full.",
+        value=stats["rejected"],
+    )
+
+    cache = CounterMetricFamily(
+        "jetstream_http_cache_events",
+        "Completion cache lookups and evictions by outcome.",
+        labels=["event"],
+    )
+    for event in ("hits", "misses", "merged", "evictions"):
+      cache.add_metric([event], getattr(completion_cache, event))
+    yield cache
+    yield GaugeMetricFamily(
+        "jetstream_http_cache_bytes",
+        "Bytes held by the completion cache.",
+        value=completion_cache.stats()["bytes"],
+    )
+
+    abandoned = CounterMetricFamily(
+        "jetstream_http_requests_abandoned",
+        "Requests whose upstream work was abandoned, by reason.",
+        labels=["reason"],
+    )
+    for reason, count in request_counters.items():
+      abandoned.add_metric([reason], count)
+    yield abandoned
+
+    yield GaugeMetricFamily(
+        "jetstream_http_upstream_live",
+        "Whether the last cached orchestrator HealthCheck reported live.",
+        value=1 if health_prober.healthy() else 0,
+    )
+
+
+prometheus_client.REGISTRY.register(_StatsCollector())
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: fastapi.FastAPI):
+  channel_pool.connect(GRPC_TARGET)
+  health_prober.start()
+  yield
+  await health_prober.stop()
+  await channel_pool.close()
+
+
 class GenerateRequest(pydantic.BaseModel):
-  server: Optional[str] = "127.0.0.1"
-  port: Optional[str] = "9000"
+  server: Optional[str] = GRPC_SERVER
+  port: Optional[str] = GRPC_PORT
   session_cache: Optional[str] = ""
   prompt: Optional[str] = "This is an example prompt"
   priority: Optional[int] = 0
   max_tokens: Optional[int] = 100
   stream: Optional[bool] = False
+  # "json" keeps the original back-to-back pretty-printed objects; "sse" and
+  # "ndjson" emit delimited compact frames sharing one id per stream.
+  stream_format: Optional[Literal["json", "sse", "ndjson"]] = "json"
+  stream_flush_tokens: Optional[int] = STREAM_FLUSH_TOKENS
+  stream_flush_ms: Optional[int] = STREAM_FLUSH_MS
+  timeout_ms: Optional[int] = None
+
+  def target(self) -> str:
+    return f"{self.server}:{self.port}"
+
+  def decode_request(self) -> jetstream_pb2.DecodeRequest:
+    return jetstream_pb2.DecodeRequest(
+        session_cache=self.session_cache,
+        text_content=jetstream_pb2.DecodeRequest.TextContent(text=self.prompt),
+        priority=self.priority,
+        max_tokens=self.max_tokens,
+    )
 
 
-app = fastapi.FastAPI()
-executor = concurrent.futures.ThreadPoolExecutor(max_workers=1000)
+class GenerateBatchRequest(pydantic.BaseModel):
+  """Either `prompts`, sharing the settings below, or full `requests`."""
+  server: Optional[str] = GRPC_SERVER
+  port: Optional[str] = GRPC_PORT
+  session_cache: Optional[str] = ""
+  priority: Optional[int] = 0
+  max_tokens: Optional[int] = 100
+  prompts: Optional[List[str]] = None
+  requests: Optional[List[GenerateRequest]] = None
+  concurrency: Optional[int] = None
+
+  def items(self) -> List[GenerateRequest]:
+    items = list(self.requests or [])
+    for prompt in self.prompts or []:
+      items.append(
+          GenerateRequest(
+              server=self.server,
+              port=self.port,
+              session_cache=self.session_cache,
+              priority=self.priority,
+              max_tokens=self.max_tokens,
+              prompt=prompt,
+          )
+      )
+    return items
+
+
+app = fastapi.FastAPI(lifespan=lifespan)
 
 @app.get("/")
 def root():
@@ -52,91 +916,459 @@ def root():
   )
   return response
 
+@app.get("/stats")
+def stats():
+  """Connection pool, admission queue and cache statistics."""
+  response = {
+      "channels": channel_pool.stats(),
+      "admission": admission.stats(),
+      "cache": completion_cache.stats(),
+      "requests": dict(request_counters),
+      "health": health_prober.stats(),
+  }
+  response = fastapi.Response(
+      content=json.dumps(response, indent=4), media_type="application/json"
+  )
+  return response
+
+@app.get("/metrics")
+def metrics():
+  """Prometheus metrics."""
+  return fastapi.Response(
+      content=prometheus_client.generate_latest(),
+      media_type=prometheus_client.CONTENT_TYPE_LATEST,
+  )
+
+_LIVE_BODY = json.dumps({"response": {"is_live": True}}, indent=4)
+
 @app.get("/healthcheck")
 async def healthcheck():
-  try:
-    request = jetstream_pb2.HealthCheckRequest()
-
-    options = [("grpc.keepalive_timeout_ms", 10000)]
-    async with grpc.aio.insecure_channel("127.0.0.1:9000", options=options) as channel:
-      stub = jetstream_pb2_grpc.OrchestratorStub(channel)
-      response = stub.HealthCheck(request)
-      response = await response
+  """Answers from the background HealthCheck result."""
+  if not health_prober.healthy():
+    detail = "Healthcheck failed"
+    if health_prober.error:
+      detail += f", {health_prober.error}"
+    elif health_prober.checked_at is not None:
+      detail += ", result is stale"
+    raise fastapi.HTTPException(status_code=500, detail=detail)
+  return fastapi.Response(content=_LIVE_BODY, media_type="application/json")
 
-      if response.is_live == False:
-        raise fastapi.HTTPException(status_code=500, detail="Healthcheck failed, is_live = False")
+@app.get("/ready")
+async def ready():
+  """Readiness: upstream healthy and the admission queue not saturated."""
+  queue_depth = admission.queue_depth
+  saturated = queue_depth >= READY_MAX_QUEUE_FRACTION * MAX_QUEUE
+  is_ready = health_prober.healthy() and not saturated
+  response = {
+      "ready": is_ready,
+      "is_live": health_prober.is_live,
+      "age_s": health_prober.age_s(),
+      "queue_depth": queue_depth,
+      "max_queue": MAX_QUEUE,
+  }
+  return fastapi.Response(
+      content=json.dumps(response, indent=4),
+      media_type="application/json",
+      status_code=200 if is_ready else 503,
+  )
 
-      is_live = {"is_live": response.is_live}
-      response = {"response": is_live}
 
-      response = fastapi.Response(
-          content=json.dumps(response, indent=4), media_type="application/json"
+def _timeout_ms(request: GenerateRequest, http_request: fastapi.Request):
+  """Returns the strictest of the field, header and default timeouts."""
+  timeouts = [request.timeout_ms, REQUEST_TIMEOUT_MS]
+  header = http_request.headers.get("x-request-timeout-ms")
+  if header:
+    try:
+      timeouts.append(int(header))
+    except ValueError:
+      raise fastapi.HTTPException(
+          status_code=400, detail="Invalid X-Request-Timeout-Ms header"
       )
-      return response
+  timeouts = [t for t in timeouts if t and t > 0]
+  return min(timeouts) if timeouts else None
 
-  except Exception as e:
-    logging.exception("Exception in healthcheck")
-    logging.exception(e)
-    raise fastapi.HTTPException(status_code=500, detail="Healthcheck failed")
+
+async def _until_disconnected(http_request: fastapi.Request, coro, deadline):
+  """Awaits `coro`, cancelling it on client disconnect or deadline expiry."""
+  loop = asyncio.get_running_loop()
+  poll_s = DISCONNECT_POLL_MS / 1000
+  task = asyncio.ensure_future(coro)
+  try:
+    while True:
+      timeout = poll_s
+      if deadline is not None:
+        timeout = max(0, min(timeout, deadline - loop.time()))
+      await asyncio.wait({task}, timeout=timeout)
+      if task.done():
+        return task.result()
+      if deadline is not None and loop.time() >= deadline:
+        raise DeadlineExceededError()
+      if await http_request.is_disconnected():
+        raise ClientDisconnectedError()
+  finally:
+    task.cancel()
+
+
+async def _generate_admitted(
+    request: jetstream_pb2.DecodeRequest,
+    target: str,
+    priority: int,
+    deadline: Optional[float] = None,
+    shed: bool = True,
+):
+  """Answers from the cache or decodes under an admission slot.
+
+  Only a request that starts a Decode call takes a slot; one that joins a
+  running call for the same key issues no RPC. Returns the decoded text and
+  the time spent waiting for the slot.
+  """
+  if completion_cache.enabled:
+    key = completion_cache.key(request, target)
+    text = completion_cache.get(key)
+    if text is not None:
+      return text, 0.0
+    # Nothing awaits between this check and subscribing in tokens(), so the
+    # flight is still running when generate_prompt joins it.
+    if completion_cache.in_flight(key):
+      return await generate_prompt(request, target, deadline), 0.0
+  async with admission.slot(priority, shed) as queue_wait:
+    if not completion_cache.enabled or not completion_cache.in_flight(key):
+      return await generate_prompt(request, target, deadline), queue_wait
+  # An identical request started a call while this one was queued.
+  return await generate_prompt(request, target, deadline), queue_wait
 
 
 @app.post("/generate", status_code=200)
-async def generate(request: GenerateRequest):
+async def generate(request: GenerateRequest, http_request: fastapi.Request):
   """Generate a prompt."""
   try:
     stream = request.stream
-    request = jetstream_pb2.DecodeRequest(
-        session_cache=request.session_cache,
-        text_content=jetstream_pb2.DecodeRequest.TextContent(text=request.prompt),
-        priority=request.priority,
-        max_tokens=request.max_tokens,
-    )
+    stream_format = request.stream_format or "json"
+    flush_tokens = request.stream_flush_tokens or 0
+    flush_ms = request.stream_flush_ms or 0
+    priority = request.priority
+    deadline = deadline_after(_timeout_ms(request, http_request))
+    target = request.target()
+    channel_pool.connect(target)
+    request = request.decode_request()
 
     if stream:
-      response = StreamingResponse(generate_prompt_stream(request), media_type="application/json")
+      if stream_format == "json":
+        content = generate_prompt_stream(request, target, deadline)
+        media_type = "application/json"
+      else:
+        encode_frame, media_type = STREAM_FORMATS[stream_format]
+        content = generate_prompt_frames(
+            request, target, encode_frame, flush_tokens, flush_ms, deadline
+        )
+      response = StreamingResponse(content, media_type=media_type)
       return response
 
     else:
-      future = executor.submit(generate_prompt, request)
-      response = await future.result()
+      response, queue_wait = await _until_disconnected(
+          http_request,
+          _generate_admitted(request, target, priority, deadline),
+          deadline,
+      )
       response = {"response": response}
       response = fastapi.Response(
-          content=json.dumps(response, indent=4), media_type="application/json"
+          content=json.dumps(response, indent=4),
+          media_type="application/json",
+          headers={"X-Queue-Wait-Ms": f"{queue_wait * 1000:.1f}"},
       )
       return response
+  except QueueFullError as e:
+    raise fastapi.HTTPException(
+        status_code=429,
+        detail=str(e),
+        headers={"Retry-After": str(RETRY_AFTER_S)},
+    )
+  except DeadlineExceededError as e:
+    request_counters["deadline_exceeded"] += 1
+    raise fastapi.HTTPException(status_code=504, detail=str(e))
+  except ClientDisconnectedError as e:
+    request_counters["cancelled"] += 1
+    # Nobody is listening; the status only shows up in access logs.
+    raise fastapi.HTTPException(status_code=499, detail=str(e))
+  except fastapi.HTTPException:
+    raise
   except Exception as e:
     logging.exception("Exception in generate")
     raise fastapi.HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/generate_batch", status_code=200)
+async def generate_batch(
+    http_request: fastapi.Request, concurrency: Optional[int] = None
+):
+  """Generate a batch of prompts, streamed back as NDJSON in completion order.
+
+  The body is either a JSON `GenerateBatchRequest` or JSONL with one
+  `GenerateRequest` per line. Every result line carries the item's index.
+  An item's `timeout_ms` counts from the moment the item is started.
+  """
+  body = await http_request.body()
+  try:
+    content_type = http_request.headers.get("content-type", "")
+    if "ndjson" in content_type or "jsonl" in content_type:
+      items = [
+          GenerateRequest(**json.loads(line))
+          for line in body.decode().splitlines()
+          if line.strip()
+      ]
+    else:
+      batch = GenerateBatchRequest(**json.loads(body))
+      items = batch.items()
+      concurrency = concurrency or batch.concurrency
+  except (ValueError, TypeError) as e:
+    raise fastapi.HTTPException(status_code=400, detail=str(e))
+
+  if len(items) > BATCH_MAX_ITEMS:
+    raise fastapi.HTTPException(
+        status_code=413,
+        detail=f"Batch has {len(items)} items, limit is {BATCH_MAX_ITEMS}",
+    )
+  streamed = [index for index, item in enumerate(items) if item.stream]
+  if streamed:
+    raise fastapi.HTTPException(
+        status_code=400,
+        detail=f"Batch items cannot stream; unset stream on items {streamed[:10]}",
+    )
+  for target in {item.target() for item in items}:
+    channel_pool.connect(target)
+  concurrency = min(concurrency or BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY)
+  concurrency = max(1, min(concurrency, len(items)))
+  # Every worker may be waiting for a slot at once, so they take queue
+  # places like other requests do.
+  try:
+    reservation = admission.reserve(concurrency)
+  except QueueFullError as e:
+    raise fastapi.HTTPException(
+        status_code=429,
+        detail=str(e),
+        headers={"Retry-After": str(RETRY_AFTER_S)},
+    )
+  return StreamingResponse(
+      generate_batch_results(items, concurrency, reservation),
+      media_type="application/x-ndjson",
+  )
+
+
+async def generate_batch_results(
+    items: List[GenerateRequest],
+    concurrency: int,
+    reservation: Optional[QueueReservation] = None,
+):
+  """Decodes `items` with at most `concurrency` in flight, yielding results.
+
+  `reservation` holds the queue places of the workers and is released when
+  the results end.
+  """
+
+  results = asyncio.Queue()
+  indices = iter(range(len(items)))
+
+  async def worker():
+    for index in indices:
+      item = items[index]
+      timeout_ms = item.timeout_ms or REQUEST_TIMEOUT_MS
+      try:
+        coro = _generate_admitted(
+            item.decode_request(),
+            item.target(),
+            item.priority,
+            deadline_after(timeout_ms),
+            shed=False,
+        )
+        if timeout_ms:
+          text, _ = await asyncio.wait_for(coro, timeout_ms / 1000)
+        else:
+          text, _ = await coro
+        result = {"index": index, "response": text}
+      except (DeadlineExceededError, asyncio.TimeoutError):
+        request_counters["deadline_exceeded"] += 1
+        result = {"index": index, "error": str(DeadlineExceededError())}
+      except Exception as e:
+        logging.exception("Exception in generate_batch item %d", index)
+        result = {"index": index, "error": str(e)}
+      results.put_nowait(result)
+
+  workers = [
+      asyncio.create_task(worker())
+      for _ in range(min(concurrency, len(items)))
+  ]
+  try:
+    for _ in range(len(items)):
+      yield _ndjson_frame(await results.get())
+  except (asyncio.CancelledError, GeneratorExit):
+    request_counters["cancelled"] += 1
+    raise
+  finally:
+    for task in workers:
+      task.cancel()
+    if reservation is not None:
+      reservation.release()
+
+
+async def decode_tokens(
+    request: jetstream_pb2.DecodeRequest,
+    target: str = GRPC_TARGET,
+    deadline: Optional[float] = None,
+):
+  """Yields the text of each token streamed back by the orchestrator."""
+
+  timeout = None
+  if deadline is not None:
+    timeout = deadline - asyncio.get_running_loop().time()
+    if timeout <= 0:
+      raise DeadlineExceededError()
+  with channel_pool.call(target) as stub:
+    response = stub.Decode(request, timeout=timeout)
+    try:
+      async for r in response:
+        yield r.stream_content.samples[0].text
+    except grpc.aio.AioRpcError as e:
+      if e.code() == grpc.StatusCode.DEADLINE_EXCEEDED:
+        raise DeadlineExceededError() from e
+      raise
+    finally:
+      # The channel outlives the request, so stop the call explicitly when
+      # the consumer goes away before the stream is drained.
+      response.cancel()
+
 async def generate_prompt(
     request: jetstream_pb2.DecodeRequest,
+    target: str = GRPC_TARGET,
+    deadline: Optional[float] = None,
 ):
   """Generate a prompt."""
 
-  options = [("grpc.keepalive_timeout_ms", 10000)]
-  async with grpc.aio.insecure_channel("127.0.0.1:9000", options=options) as channel:
-    stub = jetstream_pb2_grpc.OrchestratorStub(channel)
-    response = stub.Decode(request)
-    output = ""
-    async for r in response:
-      output += str(r.stream_content.samples[0].text)
-    return output
+  timer = RequestTimer("unary")
+  output = ""
+  try:
+    async for token in completion_cache.tokens(request, target, deadline):
+      timer.token()
+      output += str(token)
+  finally:
+    timer.finish()
+  return output
 
 async def generate_prompt_stream(
     request: jetstream_pb2.DecodeRequest,
+    target: str = GRPC_TARGET,
+    deadline: Optional[float] = None,
 ):
   """Generate a prompt streamed."""
 
-  options = [("grpc.keepalive_timeout_ms", 10000)]
-  async with grpc.aio.insecure_channel("127.0.0.1:9000", options=options) as channel:
-    stub = jetstream_pb2_grpc.OrchestratorStub(channel)
-    response = stub.Decode(request)
-    async for r in response:
+  timer = RequestTimer("stream")
+  try:
+    async for token in completion_cache.tokens(request, target, deadline):
+      timer.token()
       request_id = "generate-" + str(uuid.uuid4().hex)
       chunk = {
         "id": request_id,
         "time_created": time.time(),
-        "text": str(r.stream_content.samples[0].text)
+        "text": str(token)
       }
-      yield json.dumps(chunk, indent=4)
\ No newline at end of file
+      yield json.dumps(chunk, indent=4)
+  except DeadlineExceededError:
+    request_counters["deadline_exceeded"] += 1
+  except (asyncio.CancelledError, GeneratorExit):
+    request_counters["cancelled"] += 1
+    raise
+  finally:
+    timer.finish()
+
+def _json_compact(chunk) -> str:
+  return json.dumps(chunk, separators=(",", ":"), ensure_ascii=False)
+
+def _ndjson_frame(chunk) -> str:
+  return _json_compact(chunk) + "\n"
+
+def _sse_frame(chunk) -> str:
+  return "data: " + _json_compact(chunk) + "\n\n"
+
+STREAM_FORMATS = {
+    "ndjson": (_ndjson_frame, "application/x-ndjson"),
+    "sse": (_sse_frame, "text/event-stream"),
+}
+
+async def generate_prompt_frames(
+    request: jetstream_pb2.DecodeRequest,
+    target: str = GRPC_TARGET,
+    encode_frame=_ndjson_frame,
+    flush_tokens: int = 0,
+    flush_ms: int = 0,
+    deadline: Optional[float] = None,
+):
+  """Generate a prompt streamed as delimited, optionally coalesced frames.
+
+  Every frame carries the same request id. Tokens are buffered until
+  `flush_tokens` tokens have accumulated or `flush_ms` milliseconds have
+  passed since the last frame, whether or not another token arrived; the
+  stream ends with a frame holding `"done": true` and the token count, or
+  with an `"error"` frame if the deadline passes first.
+  """
+
+  request_id = "generate-" + uuid.uuid4().hex
+  flush_s = flush_ms / 1000
+  flush_each = not flush_tokens and not flush_s
+  pending = []
+  tokens = 0
+  last_flush = time.monotonic()
+
+  timer = RequestTimer("stream")
+  error = None
+  tokens_iter = completion_cache.tokens(request, target, deadline).__aiter__()
+  next_token = None
+  try:
+    while True:
+      if next_token is None:
+        next_token = asyncio.ensure_future(tokens_iter.__anext__())
+      timeout = None
+      if flush_s and pending:
+        timeout = max(0.0, last_flush + flush_s - time.monotonic())
+      # asyncio.wait, unlike wait_for, leaves the pending read running when
+      # the flush interval expires first.
+      done, _ = await asyncio.wait({next_token}, timeout=timeout)
+      if not done:
+        yield encode_frame({"id": request_id, "text": "".join(pending)})
+        pending.clear()
+        last_flush = time.monotonic()
+        continue
+      try:
+        token = next_token.result()
+      except StopAsyncIteration:
+        break
+      finally:
+        next_token = None
+      timer.token()
+      pending.append(token)
+      tokens += 1
+      if (
+          flush_each
+          or (flush_tokens and len(pending) >= flush_tokens)
+          or (flush_s and time.monotonic() - last_flush >= flush_s)
+      ):
+        yield encode_frame({"id": request_id, "text": "".join(pending)})
+        pending.clear()
+        last_flush = time.monotonic()
+  except DeadlineExceededError as e:
+    request_counters["deadline_exceeded"] += 1
+    error = e
+  except (asyncio.CancelledError, GeneratorExit):
+    request_counters["cancelled"] += 1
+    raise
+  finally:
+    # Before any await: a disconnect cancels this generator again there.
+    timer.finish()
+    if next_token is not None:
+      # Cancelling the read also cancels the upstream Decode call.
+      next_token.cancel()
+      await asyncio.gather(next_token, return_exceptions=True)
+  if pending:
+    yield encode_frame({"id": request_id, "text": "".join(pending)})
+  if error is not None:
+    yield encode_frame({"id": request_id, "error": str(error), "tokens": tokens})
+  else:
+    yield encode_frame({"id": request_id, "done": True, "tokens": tokens})
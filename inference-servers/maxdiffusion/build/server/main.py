@@ -1,6 +1,16 @@
+import base64
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
 import io
+import json
+import os
+import tempfile
+import threading
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import Response
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 import logging
 import logging.config
@@ -19,6 +29,40 @@ from jax.experimental.compilation_cache import compilation_cache as cc
 from maxdiffusion import FlaxStableDiffusionXLPipeline
 
 ROOT_LEVEL = "INFO"
+# How long the first request of a batch waits for others to share its
+# device pass.
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "25"))
+# Requests allowed to wait for the device before /generate answers 429.
+MAX_QUEUE = int(os.getenv("MAX_QUEUE", "32"))
+RETRY_AFTER_S = int(os.getenv("RETRY_AFTER_S", "5"))
+# Entries in each of the tokenized and device-resident prompt caches.
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", "256"))
+# Compiled (steps, height, width) variants kept in memory at once, besides
+# the default and PREWARM_VARIANTS ones, which are never evicted.
+MAX_EXECUTABLES = int(os.getenv("MAX_EXECUTABLES", "4"))
+# Extra variants compiled in the background at startup, as a comma separated
+# list of STEPSxHEIGHTxWIDTH, e.g. "20x1024x1024,30x768x768".
+PREWARM_VARIANTS = os.getenv("PREWARM_VARIANTS", "")
+MAX_STEPS = int(os.getenv("MAX_STEPS", "100"))
+MAX_RESOLUTION = int(os.getenv("MAX_RESOLUTION", "1024"))
+# Output encoding defaults; requests override them with format, quality and
+# compress_level, or pick the format through the Accept header.
+DEFAULT_IMAGE_FORMAT = os.getenv("DEFAULT_IMAGE_FORMAT", "png")
+PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", "1"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "90"))
+ENCODE_WORKERS = int(os.getenv("ENCODE_WORKERS", str(os.cpu_count() or 4)))
+# Byte budgets of the encoded image cache. The disk tier is off unless
+# RESULT_CACHE_DIR is set.
+RESULT_CACHE_BYTES = int(os.getenv("RESULT_CACHE_BYTES", str(256 * 1024 * 1024)))
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "")
+RESULT_CACHE_DISK_BYTES = int(os.getenv("RESULT_CACHE_DISK_BYTES", str(4 * 1024 * 1024 * 1024)))
+MODEL_ID = "stabilityai/stable-diffusion-xl-base-1.0"
+MODEL_REVISION = "refs/pr/95"
+# Load the model and compile in the background after the server binds, so
+# /health answers during startup and /ready reports progress. Set to false
+# to load everything before serving, as before.
+FAST_START = os.getenv("FAST_START", "true").lower() in ("1", "true", "yes")
+JAX_CACHE_DIR = os.getenv("JAX_CACHE_DIR", os.path.expanduser("~/jax_cache"))
 
 LOGGING_CONFIG = {
     "version": 1,
@@ -57,7 +101,17 @@ LOG = logging.getLogger(__name__)
 LOG.info("API is starting up")
 LOG.info(uvicorn.Config.asgi_version)
 
-app = FastAPI()
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    batcher.start()
+    if FAST_START:
+        threading.Thread(
+            target=load_model_logged, name="model-loader", daemon=True
+        ).start()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 origins = ["*"]
 app.add_middleware(
     CORSMiddleware,
@@ -68,9 +122,67 @@ app.add_middleware(
 
 @app.get("/health")
 async def health() -> Response:
-    """Health check."""
+    """Health check; fails once model loading has failed so the pod restarts."""
+    if startup.error:
+        return JSONResponse({"error": startup.error}, status_code=500)
     return Response(status_code=200)
 
+
+class StartupPhases:
+    """Progress and durations of the model loading phases for /ready."""
+
+    def __init__(self, names):
+        self._phases = {
+            name: {"status": "pending", "duration_s": None} for name in names
+        }
+        self._started = time.time()
+        self.error = None
+
+    @property
+    def ready(self):
+        return all(p["status"] == "done" for p in self._phases.values())
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        info = self._phases[name]
+        info["status"] = "running"
+        LOG.info(json.dumps({"event": "startup_phase", "phase": name, "status": "running"}))
+        start = time.time()
+        try:
+            yield
+        except BaseException as e:
+            info["status"] = "failed"
+            self.error = f"{name}: {e}"
+            raise
+        else:
+            info["status"] = "done"
+        finally:
+            info["duration_s"] = time.time() - start
+            LOG.info(json.dumps({
+                "event": "startup_phase",
+                "phase": name,
+                "status": info["status"],
+                "duration_s": round(info["duration_s"], 3),
+                "since_start_s": round(time.time() - self._started, 3),
+            }))
+
+    def as_dict(self):
+        return {
+            "ready": self.ready,
+            "error": self.error,
+            "elapsed_s": time.time() - self._started,
+            "phases": {name: dict(info) for name, info in self._phases.items()},
+        }
+
+
+startup = StartupPhases(["load", "cast", "replicate", "compile"])
+
+
+@app.get("/ready")
+async def ready() -> JSONResponse:
+    """Readiness check; 503 until the model is loaded and compiled."""
+    return JSONResponse(startup.as_dict(), status_code=200 if startup.ready else 503)
+
 @app.get("/")
 async def read_root():
     message = f"Hello world! From FastAPI running on Uvicorn with Gunicorn."
@@ -79,23 +191,18 @@ async def read_root():
 # Let's cache the model compilation, so that it doesn't take as long the next time around.
 
 # Load the Stable Diffusion model
-cc.initialize_cache("~/jax_cache")
+# Executables compiled by earlier runs are reused from this directory.
+cc.initialize_cache(JAX_CACHE_DIR)
 
 NUM_DEVICES = jax.device_count()
 if(NUM_DEVICES>0):
    LOG.info("TPU Devices Detected:")
-# 1. Let's start by downloading the model and loading it into our pipeline class
-# Adhering to JAX's functional approach, the model's parameters are returned seperatetely and
-# will have to be passed to the pipeline during inference
-pipeline, params = FlaxStableDiffusionXLPipeline.from_pretrained(
-    "stabilityai/stable-diffusion-xl-base-1.0", revision="refs/pr/95", split_head_dim=True
-)
-LOG.info("parameters preparation")
-# 2. We cast all parameters to bfloat16 EXCEPT the scheduler which we leave in
-# float32 to keep maximal precision
-scheduler_state = params.pop("scheduler")
-params = jax.tree_util.tree_map(lambda x: x.astype(jnp.bfloat16), params)
-params["scheduler"] = scheduler_state
+# The model, its device copies and the executables are filled in by
+# load_model(), step 7.
+pipeline = None
+p_params = None
+p_neg_prompt_ids = None
+p_guidance = None
 
 # 3. Next, we define the different inputs to the pipeline
 default_prompt = "a colorful photo of a castle in the middle of a forest with trees and bushes, by Ismail Inceoglu, shadows, high contrast, dynamic shading, hdr, detailed vegetation, digital painting, digital drawing, detailed painting, a detailed digital painting, gothic art, featured on deviantart"
@@ -120,12 +227,7 @@ def tokenize_prompt(prompt, neg_prompt):
 # 5. To make full use of JAX's parallelization capabilities
 # the parameters and input tensors are duplicated across devices
 # To make sure every device generates a different image, we create
-# different seeds for each image. The model parameters won't change
-# during inference so we do not wrap them into a function
-LOG.info("replicate params:")
-p_params = replicate(params)
-
-
+# different seeds for each image.
 def replicate_all(prompt_ids, neg_prompt_ids, seed):
     p_prompt_ids = replicate(prompt_ids)
     p_neg_prompt_ids = replicate(neg_prompt_ids)
@@ -134,6 +236,62 @@ def replicate_all(prompt_ids, neg_prompt_ids, seed):
     return p_prompt_ids, p_neg_prompt_ids, rng
 
 
+def slot_rngs(seed, count):
+    # The keys devices 0..count-1 used when every device got the same
+    # request, so a seed produces the same images whichever slots it gets.
+    return list(jax.random.split(jax.random.PRNGKey(seed), NUM_DEVICES)[:count])
+
+
+def pad_slots(values):
+    """Fills the remaining device slots with copies of the last value."""
+    return list(values) + [values[-1]] * (NUM_DEVICES - len(values))
+
+
+@functools.lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def tokenized_prompt(prompt):
+    # prepare_inputs returns (batch, encoders, tokens); keep the batch of one
+    # that every device expects.
+    return np.asarray(pipeline.prepare_inputs(prompt))
+
+
+@functools.lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def sharded_prompt_ids(prompts):
+    """Device-resident ids with prompts[i] on device i, cached per layout."""
+    ids = [tokenized_prompt(prompt) for prompt in prompts]
+    return jax.device_put_sharded(ids, jax.local_devices())
+
+
+class PrepTimings:
+    """Cumulative time spent in each host-side input preparation step."""
+
+    def __init__(self):
+        self.total_s = collections.defaultdict(float)
+        self.count = collections.Counter()
+
+    @contextlib.contextmanager
+    def step(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.total_s[name] += elapsed
+            self.count[name] += 1
+            LOG.debug(f"prep {name}: {elapsed * 1000:.2f} ms")
+
+    def as_dict(self):
+        return {
+            name: {
+                "count": self.count[name],
+                "avg_ms": self.total_s[name] * 1000 / self.count[name],
+            }
+            for name in self.total_s
+        }
+
+
+prep_timings = PrepTimings()
+
+
 # 6. To compile the pipeline._generate function, we must pass all parameters
 # to the function and tell JAX which are static arguments, that is, arguments that
 # are known at compile time and won't change. In our case, it is num_inference_steps,
@@ -146,8 +304,10 @@ def aot_compile(
     seed=default_seed,
     guidance_scale=default_guidance_scale,
     num_inference_steps=default_num_steps,
+    height=height,
+    width=width,
 ):
-    LOG.info("aot compiling:")
+    LOG.info(f"aot compiling {num_inference_steps} steps at {height}x{width}:")
     prompt_ids, neg_prompt_ids = tokenize_prompt(prompt, negative_prompt)
     prompt_ids, neg_prompt_ids, rng = replicate_all(prompt_ids, neg_prompt_ids, seed)
     g = jnp.array([guidance_scale] * prompt_ids.shape[0], dtype=jnp.float32)
@@ -170,39 +330,696 @@ def aot_compile(
         .compile()
     )
 
-LOG.info("start initialized comppiling")
-start = time.time()
-LOG.info("Compiling ...")
-p_generate = aot_compile()
-LOG.info(f"Compiled in {time.time() - start}")
+class ExecutableRegistry:
+    """LRU of compiled p_generate executables keyed by (steps, height, width).
+
+    Missing variants are compiled on demand, one at a time behind a lock, and
+    the least recently used executable is dropped beyond `max_size`. Keys in
+    `pinned` (the default and prewarmed variants) are never evicted and don't
+    count towards `max_size`. The persistent compilation cache makes
+    recompiling an evicted or previously seen variant much cheaper than the
+    first compile.
+    """
+
+    def __init__(self, max_size, pinned=()):
+        self._max_size = max(1, max_size)
+        self._pinned = frozenset(pinned)
+        self._executables = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._compile_lock = threading.Lock()
+        self.hits = 0
+        self.compiles = 0
+        self.evictions = 0
+        self.compile_s = {}
 
+    def lookup(self, key):
+        """Returns the cached executable for `key`, or None."""
+        with self._lock:
+            executable = self._executables.get(key)
+            if executable is not None:
+                self._executables.move_to_end(key)
+                self.hits += 1
+            return executable
+
+    def get(self, key):
+        """Returns the executable for `key`, compiling it if needed."""
+        executable = self.lookup(key)
+        if executable is not None:
+            return executable
+        with self._compile_lock:
+            with self._lock:
+                executable = self._executables.get(key)
+            if executable is not None:
+                return executable
+            steps, height, width = key
+            start = time.time()
+            executable = aot_compile(
+                num_inference_steps=steps, height=height, width=width
+            )
+            elapsed = time.time() - start
+            LOG.info(f"Compiled {key} in {elapsed}")
+            with self._lock:
+                self.compiles += 1
+                self.compile_s[key] = elapsed
+                self._executables[key] = executable
+                unpinned = [k for k in self._executables if k not in self._pinned]
+                for evicted in unpinned[:max(0, len(unpinned) - self._max_size)]:
+                    del self._executables[evicted]
+                    self.evictions += 1
+                    LOG.info(f"Evicted executable {evicted}")
+            return executable
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "cached": ["x".join(map(str, key)) for key in self._executables],
+                "pinned": ["x".join(map(str, key)) for key in sorted(self._pinned)],
+                "max_size": self._max_size,
+                "hits": self.hits,
+                "compiles": self.compiles,
+                "evictions": self.evictions,
+                "compile_s": {
+                    "x".join(map(str, key)): s for key, s in self.compile_s.items()
+                },
+            }
+
+
+def parse_variants(spec):
+    variants = []
+    for item in filter(None, (v.strip() for v in spec.split(","))):
+        steps, h, w = (int(v) for v in item.lower().split("x"))
+        variants.append((steps, h, w))
+    return variants
+
+
+default_variant = (default_num_steps, height, width)
+prewarm_variants = parse_variants(PREWARM_VARIANTS)
+executables = ExecutableRegistry(MAX_EXECUTABLES, pinned=[default_variant, *prewarm_variants])
+# Compiles run here so neither the event loop nor the device worker blocks.
+compile_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="compiler"
+)
+
+
+
+# 7. Loading is split into phases so /ready can report where startup is.
+def load_model():
+    global pipeline, p_params, p_neg_prompt_ids, p_guidance
+    # 1. Let's start by downloading the model and loading it into our pipeline class
+    # Adhering to JAX's functional approach, the model's parameters are returned seperatetely and
+    # will have to be passed to the pipeline during inference
+    with startup.phase("load"):
+        loaded_pipeline, params = FlaxStableDiffusionXLPipeline.from_pretrained(
+            MODEL_ID, revision=MODEL_REVISION, split_head_dim=True
+        )
+    # 2. We cast all parameters to bfloat16 EXCEPT the scheduler which we leave in
+    # float32 to keep maximal precision
+    with startup.phase("cast"):
+        scheduler_state = params.pop("scheduler")
+        params = jax.tree_util.tree_map(lambda x: x.astype(jnp.bfloat16), params)
+        params["scheduler"] = scheduler_state
+    # The model parameters won't change during inference, and neither do the
+    # default negative prompt and guidance scale, so they are placed on the
+    # devices once.
+    with startup.phase("replicate"):
+        pipeline = loaded_pipeline
+        p_params = replicate(params)
+        del params
+        p_neg_prompt_ids = replicate(tokenized_prompt(default_neg_prompt))
+        p_guidance = replicate(np.array([default_guidance_scale], dtype=np.float32))
+        jax.block_until_ready((p_params, p_neg_prompt_ids, p_guidance))
+    with startup.phase("compile"):
+        executables.get(default_variant)
+    for variant in prewarm_variants:
+        compile_executor.submit(executables.get, variant)
+
+
+def load_model_logged():
+    # The error is kept in startup.error, which fails /health.
+    try:
+        load_model()
+    except Exception as e:
+        LOG.exception("model loading failed")
+        startup.error = startup.error or repr(e)
+
+
+if not FAST_START:
+    load_model()
+
+
+class ImageRequest:
+    """A /generate call for `num_images` variations of `prompt` from `seed`.
+
+    The request holds on to the executable resolved for its variant, so an
+    eviction from the registry while it is queued never leaves the device
+    worker to compile.
+    """
+
+    def __init__(self, prompt, seed, num_images, variant, executable):
+        self.prompt = prompt
+        self.seed = seed
+        self.num_images = num_images
+        self.variant = variant
+        self.executable = executable
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.perf_counter()
+        self.queue_wait_s = 0.0
+        self.device_s = 0.0
+
+
+class GenerationStats:
+    """Running totals of queue wait and device time for /stats."""
+
+    def __init__(self):
+        self.requests = 0
+        self.rejected = 0
+        self.batches = 0
+        self.images = 0
+        self.queue_wait_s = 0.0
+        self.max_queue_wait_s = 0.0
+        self.device_s = 0.0
+
+    def record_batch(self, batch, device_s):
+        self.batches += 1
+        self.device_s += device_s
+        for request in batch:
+            self.requests += 1
+            self.images += request.num_images
+            self.queue_wait_s += request.queue_wait_s
+            self.max_queue_wait_s = max(self.max_queue_wait_s, request.queue_wait_s)
+
+    def as_dict(self, queue_depth):
+        requests = max(1, self.requests)
+        return {
+            "queue_depth": queue_depth,
+            "max_queue": MAX_QUEUE,
+            "requests": self.requests,
+            "rejected": self.rejected,
+            "batches": self.batches,
+            "images": self.images,
+            "avg_queue_wait_s": self.queue_wait_s / requests,
+            "max_queue_wait_s": self.max_queue_wait_s,
+            "avg_device_s_per_batch": self.device_s / max(1, self.batches),
+            "avg_images_per_batch": self.images / max(1, self.batches),
+        }
+
+
+stats = GenerationStats()
+# All device work runs on this one thread so the event loop stays free for
+# probes and new requests while an image renders.
+device_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="device-worker"
+)
+
+
+def generate_images(requests):
+    """Renders every request's images in a single pass over the devices.
+
+    Each request occupies `num_images` consecutive device slots and all
+    requests share one (steps, height, width) variant. Returns a list of
+    HxWx3 uint8 arrays per request; padded slots are never copied to host.
+    """
+    p_generate = requests[0].executable
+    prompts, rngs = [], []
+    with prep_timings.step("rng"):
+        for request in requests:
+            keys = slot_rngs(request.seed, request.num_images)
+            prompts += [request.prompt] * len(keys)
+            rngs += keys
+        rng = jax.device_put_sharded(pad_slots(rngs), jax.local_devices())
+    LOG.info(f"generate {len(prompts)} images on {NUM_DEVICES} devices")
+    with prep_timings.step("prompt_ids"):
+        p_prompt_ids = sharded_prompt_ids(tuple(pad_slots(prompts)))
+    LOG.info("call p_generate")
+    images = p_generate(p_prompt_ids, p_params, rng, p_guidance, None, p_neg_prompt_ids)
+    images = images.reshape((images.shape[0] * images.shape[1],) + images.shape[-3:])
+    # Quantize on device, as numpy_to_pil would on host, so only a quarter
+    # of the bytes are transferred.
+    images = (images[:len(prompts)] * 255).round().astype(jnp.uint8)
+    images = np.asarray(images)
+    results, offset = [], 0
+    for request in requests:
+        results.append(list(images[offset:offset + request.num_images]))
+        offset += request.num_images
+    return results
 
-# 7. Let's now put it all together in a generate function.
+
+class RequestBatcher:
+    """Packs concurrent /generate requests into one p_generate call.
+
+    The first queued request waits up to `window_s` for more, then requests
+    for the same variant are packed in arrival order until their images fill
+    `num_slots` devices. Requests that do not fit, or need another variant,
+    are deferred to a later batch ahead of newer arrivals. Each caller gets
+    back the images rendered on its own devices.
+    """
+
+    def __init__(self, num_slots, window_s, max_queue):
+        self._num_slots = num_slots
+        self._window_s = window_s
+        self._max_queue = max_queue
+        self._queue = asyncio.Queue()
+        self._deferred = collections.deque()
+        self._held = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize() + len(self._deferred) + self._held
+
+    @contextlib.contextmanager
+    def hold_place(self):
+        """Counts a request that is still being prepared, e.g. compiled for.
+
+        Raises asyncio.QueueFull when the queue is full.
+        """
+        if self.queue_depth >= self._max_queue:
+            raise asyncio.QueueFull()
+        self._held += 1
+        try:
+            yield
+        finally:
+            self._held -= 1
+
+    async def submit(self, request):
+        """Queues `request`; raises asyncio.QueueFull when the queue is full."""
+        if self.queue_depth >= self._max_queue:
+            raise asyncio.QueueFull()
+        self._queue.put_nowait(request)
+        return await request.future
+
+    async def _collect(self):
+        if self._deferred:
+            first = self._deferred.popleft()
+        else:
+            first = await self._queue.get()
+        batch = [first]
+        used = first.num_images
+
+        def fits(request):
+            return (
+                request.variant == first.variant
+                and used + request.num_images <= self._num_slots
+            )
+
+        for request in list(self._deferred):
+            if fits(request):
+                self._deferred.remove(request)
+                batch.append(request)
+                used += request.num_images
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._window_s
+        while used < self._num_slots:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if not fits(request):
+                self._deferred.append(request)
+                continue
+            batch.append(request)
+            used += request.num_images
+        # Callers that went away no longer need a slot.
+        return [request for request in batch if not request.future.done()]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            if not batch:
+                continue
+            start = time.perf_counter()
+            for request in batch:
+                request.queue_wait_s = start - request.enqueued_at
+            try:
+                results = await loop.run_in_executor(
+                    device_executor, generate_images, batch
+                )
+            except Exception as e:
+                LOG.exception("batch generation failed")
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            device_s = time.perf_counter() - start
+            stats.record_batch(batch, device_s)
+            for request, images in zip(batch, results):
+                request.device_s = device_s
+                if not request.future.done():
+                    request.future.set_result(images)
+
+
+batcher = RequestBatcher(NUM_DEVICES, BATCH_WINDOW_MS / 1000, MAX_QUEUE)
+
+
+@app.get("/stats")
+async def get_stats():
+    response = stats.as_dict(batcher.queue_depth)
+    response["prep"] = prep_timings.as_dict()
+    response["startup"] = startup.as_dict()
+    response["executables"] = executables.as_dict()
+    response["result_cache"] = result_cache.as_dict()
+    response["prompt_cache"] = {
+        "tokenized": tokenized_prompt.cache_info()._asdict(),
+        "device": sharded_prompt_ids.cache_info()._asdict(),
+    }
+    return response
+
+
+IMAGE_FORMATS = {
+    "png": ("PNG", "image/png"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+# PIL releases the GIL while compressing, so threads encode in parallel.
+encode_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=ENCODE_WORKERS, thread_name_prefix="encoder"
+)
+
+
+def negotiate_format(data, accept):
+    """Picks the format from the request body, then Accept, then the default."""
+    image_format = data.get("format")
+    if image_format is None:
+        offered = [
+            name for name, (_, media_type) in IMAGE_FORMATS.items()
+            if media_type in accept
+        ]
+        if offered:
+            image_format = min(offered, key=lambda name: accept.index(IMAGE_FORMATS[name][1]))
+        else:
+            image_format = DEFAULT_IMAGE_FORMAT
+    image_format = str(image_format).lower().replace("jpg", "jpeg")
+    if image_format not in IMAGE_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"format must be one of {', '.join(IMAGE_FORMATS)}",
+        )
+    return image_format
+
+
+def encode_image(image, image_format, quality, compress_level):
+    buffer = io.BytesIO()
+    image = Image.fromarray(image)
+    if image_format == "png":
+        image.save(buffer, format="PNG", compress_level=compress_level)
+    else:
+        image.save(buffer, format=IMAGE_FORMATS[image_format][0], quality=quality)
+    return buffer.getvalue()
+
+
+async def encode_images(images, image_format, quality, compress_level):
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(*(
+        loop.run_in_executor(
+            encode_executor, encode_image, image, image_format, quality, compress_level
+        )
+        for image in images
+    ))
+
+
+class ResultCache:
+    """Content-addressed LRU of encoded images in memory and on disk.
+
+    A fixed seed, prompt and settings always render the same image, so the
+    encoded bytes are stored under a hash of everything that determines
+    them. Memory and disk each have their own byte budget; disk entries are
+    evicted oldest-access first and survive restarts.
+    """
+
+    def __init__(self, max_bytes, directory, max_disk_bytes):
+        self._max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._directory = directory
+        self._max_disk_bytes = max_disk_bytes
+        self._disk = collections.OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if directory:
+            self._load_disk_index()
+
+    @staticmethod
+    def key(**settings):
+        payload = json.dumps(settings, sort_keys=True).encode()
+        return hashlib.sha256(payload).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._directory, key[:2], key)
+
+    def _load_disk_index(self):
+        files = []
+        for root, _, names in os.walk(self._directory):
+            for name in names:
+                path = os.path.join(root, name)
+                if name.endswith(".tmp"):
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+                files.append((stat.st_atime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._disk[name] = size
+            self._disk_bytes += size
+        LOG.info(f"result cache: {len(self._disk)} images on disk")
+
+    def _remember(self, key, data):
+        if len(data) > self._max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old)
+        while self._entries and self._bytes + len(data) > self._max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self.evictions += 1
+        self._entries[key] = data
+        self._bytes += len(data)
+
+    def get_memory(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+            return data
+
+    def get(self, key):
+        """Returns the cached bytes for `key`, reading through to disk."""
+        data = self.get_memory(key)
+        if data is not None or not self._directory:
+            return data
+        with self._lock:
+            if key not in self._disk:
+                return None
+            self._disk.move_to_end(key)
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        with self._lock:
+            self._remember(key, data)
+            self.disk_hits += 1
+        return data
+
+    def put(self, key, data):
+        with self._lock:
+            self._remember(key, data)
+        if not self._directory or len(data) > self._max_disk_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # A unique temporary file per put, so concurrent puts of the same key
+        # never interleave; the startup scan removes any left behind.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+        with self._lock:
+            self._disk_bytes += len(data) - self._disk.pop(key, 0)
+            self._disk[key] = len(data)
+            evicted = []
+            while self._disk_bytes > self._max_disk_bytes:
+                old_key, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                self.evictions += 1
+                evicted.append(old_key)
+        for old_key in evicted:
+            with contextlib.suppress(OSError):
+                os.remove(self._path(old_key))
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self._max_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+                "max_disk_bytes": self._max_disk_bytes,
+            }
+
+
+result_cache = ResultCache(RESULT_CACHE_BYTES, RESULT_CACHE_DIR, RESULT_CACHE_DISK_BYTES)
+
+
+async def cached_images(keys):
+    """Returns the encoded images for every key, or None if any is missing."""
+    images = [result_cache.get_memory(key) for key in keys]
+    if all(image is not None for image in images):
+        return images
+    if RESULT_CACHE_DIR:
+        loop = asyncio.get_running_loop()
+        images = await asyncio.gather(*(
+            loop.run_in_executor(None, result_cache.get, key) for key in keys
+        ))
+        if all(image is not None for image in images):
+            return images
+    return None
+
+
+def log_cache_put_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        LOG.error("result cache put failed", exc_info=future.exception())
+
+
+def image_response(encoded, seed, media_type, accept, headers):
+    # A single image is returned as is unless the client asks for JSON.
+    if len(encoded) == 1 and "application/json" not in accept:
+        return Response(content=encoded[0], media_type=media_type, headers=headers)
+    return JSONResponse({
+        "seed": seed,
+        "media_type": media_type,
+        "images": [base64.b64encode(image).decode() for image in encoded],
+    }, headers=headers)
+
+
+# 8. Let's now put it all together in a generate function.
 @app.post("/generate")
 async def generate(request: Request):
     LOG.info("start generate image")
     data = await request.json()
     prompt = data["prompt"]
     LOG.info(prompt)
-    prompt_ids, neg_prompt_ids = tokenize_prompt(prompt, default_neg_prompt)
-    prompt_ids, neg_prompt_ids, rng = replicate_all(prompt_ids, neg_prompt_ids, default_seed)
-    g = jnp.array([default_guidance_scale] * prompt_ids.shape[0], dtype=jnp.float32)
-    g = g[:, None]
-    LOG.info("call p_generate")
-    images = p_generate(prompt_ids, p_params, rng, g, None, neg_prompt_ids)
+    try:
+        seed = int(data.get("seed", default_seed))
+        num_images = int(data.get("num_images", 1))
+        steps = int(data.get("num_inference_steps", default_num_steps))
+        image_height = int(data.get("height", height))
+        image_width = int(data.get("width", width))
+        quality = int(data.get("quality", IMAGE_QUALITY))
+        compress_level = int(data.get("compress_level", PNG_COMPRESS_LEVEL))
+    except (TypeError, ValueError):
+        raise HTTPException(
+            status_code=400,
+            detail="seed, num_images, num_inference_steps, height, width, quality and compress_level must be integers",
+        )
+    accept = request.headers.get("accept", "")
+    image_format = negotiate_format(data, accept)
+    if not 1 <= quality <= 100 or not 0 <= compress_level <= 9:
+        raise HTTPException(
+            status_code=400,
+            detail="quality must be between 1 and 100 and compress_level between 0 and 9",
+        )
+    if not 1 <= num_images <= NUM_DEVICES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"num_images must be between 1 and {NUM_DEVICES}",
+        )
+    if not 1 <= steps <= MAX_STEPS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"num_inference_steps must be between 1 and {MAX_STEPS}",
+        )
+    for size in (image_height, image_width):
+        if size % 64 or not 256 <= size <= MAX_RESOLUTION:
+            raise HTTPException(
+                status_code=400,
+                detail=f"height and width must be multiples of 64 between 256 and {MAX_RESOLUTION}",
+            )
+    media_type = IMAGE_FORMATS[image_format][1]
+    settings = {
+        "model": MODEL_ID,
+        "revision": MODEL_REVISION,
+        "prompt": prompt,
+        "negative_prompt": default_neg_prompt,
+        "guidance_scale": default_guidance_scale,
+        "seed": seed,
+        "steps": steps,
+        "height": image_height,
+        "width": image_width,
+        "format": image_format,
+        "quality": quality if image_format != "png" else None,
+        "compress_level": compress_level if image_format == "png" else None,
+    }
+    keys = [result_cache.key(index=i, **settings) for i in range(num_images)]
+    encoded = await cached_images(keys)
+    if encoded is not None:
+        result_cache.hits += 1
+        return image_response(encoded, seed, media_type, accept, {"X-Cache": "hit"})
+    result_cache.misses += 1
+    if not startup.ready:
+        raise HTTPException(
+            status_code=503,
+            detail="Model is still loading",
+            headers={"Retry-After": str(RETRY_AFTER_S)},
+        )
 
-    # convert the images to PIL
-    images = images.reshape((images.shape[0] * images.shape[1],) + images.shape[-3:])
-    images=pipeline.numpy_to_pil(np.array(images))
-    buffer = io.BytesIO()
+    variant = (steps, image_height, image_width)
+    try:
+        executable = executables.lookup(variant)
+        if executable is None:
+            # Requests waiting for a compile count against MAX_QUEUE.
+            with batcher.hold_place():
+                executable = await asyncio.get_running_loop().run_in_executor(
+                    compile_executor, executables.get, variant
+                )
+        image_request = ImageRequest(prompt, seed, num_images, variant, executable)
+        images = await batcher.submit(image_request)
+    except asyncio.QueueFull:
+        stats.rejected += 1
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests queued",
+            headers={"Retry-After": str(RETRY_AFTER_S)},
+        )
+
+    # encode the images in parallel off the event loop
     LOG.info("Save image")
-    for i, image in enumerate(images):
-        if i==0:
-          image.save(buffer, format="PNG")
-    #await images[0].save(buffer, format="PNG")
+    start = time.perf_counter()
+    encoded = await encode_images(images, image_format, quality, compress_level)
+    encode_s = time.perf_counter() - start
+    loop = asyncio.get_running_loop()
+    for key, image in zip(keys, encoded):
+        loop.run_in_executor(None, result_cache.put, key, image).add_done_callback(
+            log_cache_put_error
+        )
 
-    # Return the image as a response
-    return Response(content=buffer.getvalue(), media_type="image/png")
+    headers = {
+        "X-Cache": "miss",
+        "X-Queue-Wait-Ms": f"{image_request.queue_wait_s * 1000:.1f}",
+        "X-Device-Ms": f"{image_request.device_s * 1000:.1f}",
+        "X-Encode-Ms": f"{encode_s * 1000:.1f}",
+    }
+    return image_response(encoded, seed, media_type, accept, headers)
 
 if __name__ == "__main__":
    uvicorn.run(app, host="0.0.0.0", port=8000, reload=False, log_level="debug")
\ No newline at end of file
@@ -1,11 +1,30 @@
-from flask import Flask, request, send_file
+from flask import Flask, Response, request, stream_with_context
 import requests
 import os
-from PIL import Image
-from io import BytesIO
+import threading
+from requests.adapters import HTTPAdapter
+
+# Seconds to wait for the model server to connect and to send each chunk.
+CONNECT_TIMEOUT_S = float(os.getenv('CONNECT_TIMEOUT_S', '5'))
+READ_TIMEOUT_S = float(os.getenv('READ_TIMEOUT_S', '300'))
+# Generations proxied at once; further submits wait up to QUEUE_TIMEOUT_S
+# for a slot before getting a 503.
+MAX_CONCURRENCY = int(os.getenv('MAX_CONCURRENCY', '32'))
+QUEUE_TIMEOUT_S = float(os.getenv('QUEUE_TIMEOUT_S', '30'))
+CHUNK_SIZE = 64 * 1024
+# Response headers passed through from the model server.
+FORWARDED_HEADERS = ('Content-Type', 'Content-Length', 'Retry-After', 'X-Cache',
+                     'X-Queue-Wait-Ms', 'X-Device-Ms', 'X-Encode-Ms')
 
 app = Flask(__name__)
 
+# One keep-alive pool to the model server shared by all request threads.
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONCURRENCY)
+session.mount('http://', adapter)
+session.mount('https://', adapter)
+slots = threading.BoundedSemaphore(MAX_CONCURRENCY)
+
 @app.route('/', methods=['GET'])
 def index():
     html = """
@@ -30,17 +49,33 @@ def index():
 def get_image():
     prompt = request.form['prompt']
     # Get model server IP
-     
-    url=os.environ['SERVER_URL']+"/generate"
-    # Send requst
-    data = {'prompt': prompt}
-    result=requests.post(url, json = data)
-    # Get the file name from the request.
-    filename = "stable_diffusion_images.jpg"
-    content = Image.open(BytesIO(result.content))
-    content.save(filename)
-    # Serve the generated file.
-    return send_file(filename, mimetype="image/png")
+    url = os.environ['SERVER_URL'] + "/generate"
+    if not slots.acquire(timeout=QUEUE_TIMEOUT_S):
+        return Response("Too many concurrent requests", status=503,
+                        headers={'Retry-After': '5'})
+    # Send request and stream the image bytes back as they arrive, without
+    # decoding or storing them.
+    try:
+        result = session.post(url, json={'prompt': prompt}, stream=True,
+                              timeout=(CONNECT_TIMEOUT_S, READ_TIMEOUT_S))
+    except requests.Timeout:
+        slots.release()
+        return Response("Model server timed out", status=504)
+    except requests.RequestException as e:
+        slots.release()
+        return Response(f"Model server unavailable: {e}", status=502)
+
+    def body():
+        try:
+            for chunk in result.iter_content(CHUNK_SIZE):
+                yield chunk
+        finally:
+            result.close()
+            slots.release()
+
+    headers = {k: result.headers[k] for k in FORWARDED_HEADERS if k in result.headers}
+    return Response(stream_with_context(body()), status=result.status_code,
+                    headers=headers)
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=8080, threaded=True)
\ No newline at end of file